@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""
+请求处理热点路径的微基准测试
+
+在进程内直接调用 WSGIHandler 和各个组件，不经过网络，结果可以重复比较
+每一项报告每秒操作数，以及 tracemalloc 统计的每次操作的内存分配：
+    peak  单次操作过程中的内存峰值（字节）
+    net   多次操作后仍然没有释放的内存，平均到每次操作（字节），持续大于 0 通常意味着泄漏
+
+用法：
+    python bench.py                       运行全部基准测试
+    python bench.py match_url             只运行名称包含 match_url 的项目
+    python bench.py --json > base.json    以 JSON 格式输出结果
+    python bench.py --compare base.json   与之前的结果比较，变慢超过 --threshold（默认 0.1）时返回 1
+"""
+
+import argparse
+import gc
+import inspect
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import my_bottle
+
+
+BENCHMARKS = []
+# 环境变量由测试客户端构造，与测试使用同一套请求构造逻辑
+CLIENT = my_bottle.TestClient()
+
+
+def benchmark(name):
+    """
+    注册一个基准测试，被装饰的函数完成准备工作后返回一个无参数的操作函数
+    需要在测试结束后清理时，可以写成生成器，用 yield 产出操作函数
+    """
+
+    def wrapper(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+
+    return wrapper
+
+
+def measure(op, duration=0.2, repeat=5):
+    """
+    返回 (每秒操作数, 内存峰值字节, 每次操作残留字节)
+    与 timeit 相同，计时期间关闭垃圾回收；内存统计单独进行，tracemalloc 本身会让操作变慢很多
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        rate = ops_per_second(op, duration, repeat)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return (rate,) + allocations(op, min(int(rate * duration), 1000) or 1)
+
+
+def ops_per_second(op, duration, repeat):
+    """
+    先估算一轮大约运行 duration 秒需要的次数，取 repeat 轮中最快的一轮
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            op()
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration / 10:
+            break
+        number *= 10
+    number = max(1, int(number * duration / elapsed))
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            op()
+        best = min(best, time.perf_counter() - start)
+    return number / best
+
+
+def allocations(op, count):
+    """
+    返回 (单次操作的内存峰值字节, 每次操作残留字节)
+    """
+    op()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    op()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    base = tracemalloc.get_traced_memory()[0]
+    for _ in range(count):
+        op()
+    net = (tracemalloc.get_traced_memory()[0] - base) / count
+    tracemalloc.stop()
+    return peak, net
+
+
+@contextmanager
+def isolated_routes():
+    """
+    临时替换全局路由表，退出时恢复
+    """
+    saved = (my_bottle.ROUTES_SIMPLE, my_bottle.ROUTES_REGEXP, my_bottle.ROUTES_TREE)
+    my_bottle.ROUTES_SIMPLE, my_bottle.ROUTES_REGEXP, my_bottle.ROUTES_TREE = {}, {}, {}
+    my_bottle.ROUTE_CACHE.clear()
+    try:
+        yield
+    finally:
+        my_bottle.ROUTES_SIMPLE, my_bottle.ROUTES_REGEXP, my_bottle.ROUTES_TREE = saved
+        my_bottle.ROUTE_CACHE.clear()
+
+
+def start_response(status, headers):
+    pass
+
+
+def handler(**args):
+    return 'ok'
+
+
+# 路由匹配：静态路由查表，正则路由搜索前缀树，都匹配最后添加的一条
+for _size in (10, 100, 1000):
+    @benchmark('match_url static %d routes' % _size)
+    def _(size=_size):
+        with isolated_routes():
+            for i in range(size):
+                my_bottle.add_route('/static/page%d' % i, handler)
+            url = '/static/page%d' % (size - 1)
+            yield lambda: my_bottle.match_url(url)
+
+    @benchmark('match_url regex %d routes' % _size)
+    def _(size=_size):
+        with isolated_routes():
+            for i in range(size):
+                my_bottle.add_route('/user%d/:id#[0-9]+#/:action' % i, handler)
+            url = '/user%d/42/edit' % (size - 1)
+            yield lambda: my_bottle.match_url(url)
+
+
+@benchmark('compile_route')
+def _():
+    # re 模块会缓存编译结果，循环使用足够多的不同路由使缓存失效
+    routes = ['/user%d/:id#[0-9]+#/:action' % i for i in range(1000)]
+    index = iter(range(sys.maxsize))
+    return lambda: my_bottle.compile_route(routes[next(index) % 1000])
+
+
+@benchmark('HeaderDict set/get/items')
+def _():
+    def op():
+        header = my_bottle.HeaderDict()
+        header['content-type'] = 'text/html; charset=UTF-8'
+        header['Content-Length'] = '2'
+        header.add('Set-Cookie', 'a=1')
+        header.add('set-cookie', 'b=2')
+        header.get('CONTENT-TYPE')
+        'content-length' in header
+        list(header.items())
+
+    return op
+
+
+@benchmark('Request.GET 10 params')
+def _():
+    environ = CLIENT.build_environ(query=[('key%d' % i, 'value %d' % i) for i in range(10)])
+
+    def op():
+        my_bottle.request.bind(environ)
+        return my_bottle.request.GET
+
+    return op
+
+
+@benchmark('Request.POST urlencoded 10 fields')
+def _():
+    environ = CLIENT.build_environ(method='POST', data=[('key%d' % i, 'value %d' % i) for i in range(10)])
+
+    def op():
+        environ['wsgi.input'].seek(0)
+        my_bottle.request.bind(environ)
+        return my_bottle.request.POST
+
+    return op
+
+
+@benchmark('Request.POST multipart 2 fields 1 file')
+def _():
+    environ = CLIENT.build_environ(method='POST', data={'key0': 'value 0', 'key1': 'value 1'},
+                                  files={'upload': ('hello.txt', b'hello world')})
+
+    def op():
+        environ['wsgi.input'].seek(0)
+        my_bottle.request.bind(environ)
+        return my_bottle.request.POST
+
+    return op
+
+
+@benchmark('Request.COOKIES 5 cookies')
+def _():
+    environ = CLIENT.build_environ(cookies={'name%d' % i: 'value%d' % i for i in range(5)})
+
+    def op():
+        my_bottle.request.bind(environ)
+        return my_bottle.request.COOKIES
+
+    return op
+
+
+@benchmark('Response cookie emission 3 cookies')
+def _():
+    def op():
+        my_bottle.response.bind()
+        my_bottle.response.set_cookie('session', 'abcdef0123456789', path='/', httponly=True)
+        my_bottle.response.set_cookie('theme', 'dark', **{'max-age': 3600})
+        my_bottle.response.set_cookie('lang', 'zh')
+        my_bottle.finish_output([b''])
+
+    return op
+
+
+@benchmark('WSGIHandler static route')
+def _():
+    with isolated_routes():
+        my_bottle.add_route('/', handler)
+        environ = CLIENT.build_environ('/')
+        yield lambda: b''.join(my_bottle.WSGIHandler(environ, start_response))
+
+
+@benchmark('WSGIHandler regex route')
+def _():
+    with isolated_routes():
+        my_bottle.add_route('/hello/:name', lambda name: 'Hello %s!' % name)
+        environ = CLIENT.build_environ('/hello/world')
+        yield lambda: b''.join(my_bottle.WSGIHandler(environ, start_response))
+
+
+@benchmark('WSGIHandler regex route with metrics')
+def _():
+    with isolated_routes():
+        my_bottle.add_route('/hello/:name', lambda name: 'Hello %s!' % name)
+        environ = CLIENT.build_environ('/hello/world')
+        my_bottle.METRICS = my_bottle.RouteMetrics()
+        try:
+            yield lambda: b''.join(my_bottle.WSGIHandler(environ, start_response))
+        finally:
+            my_bottle.METRICS = None
+
+
+@benchmark('TestClient.get regex route')
+def _():
+    # 包括构造环境变量和解析响应的开销，即一个请求级测试的代价
+    with isolated_routes():
+        my_bottle.add_route('/hello/:name', lambda name: 'Hello %s!' % name)
+        yield lambda: CLIENT.get('/hello/world')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='my_bottle microbenchmarks')
+    parser.add_argument('filter', nargs='?', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('--duration', type=float, default=0.2, help='seconds per timing round')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--compare', help='JSON file of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed slowdown when comparing')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {item['name']: item for item in json.load(f)}
+
+    results = []
+    regressions = []
+    for name, setup in BENCHMARKS:
+        if args.filter not in name:
+            continue
+        op = setup()
+        if inspect.isgenerator(op):
+            cleanup, op = op, next(op)
+            try:
+                ops, peak, net = measure(op, args.duration)
+            finally:
+                cleanup.close()
+        else:
+            ops, peak, net = measure(op, args.duration)
+        results.append({'name': name, 'ops': round(ops, 1), 'peak_bytes': peak, 'net_bytes': round(net, 1)})
+        if not args.json:
+            line = '%-40s %12.0f ops/s %8d B peak %8.1f B net' % (name, ops, peak, net)
+            if name in baseline:
+                change = ops / baseline[name]['ops'] - 1
+                line += ' %+6.1f%%' % (change * 100)
+                if change < -args.threshold:
+                    regressions.append(name)
+                    line += '  REGRESSION'
+            print(line)
+        elif name in baseline and ops / baseline[name]['ops'] - 1 < -args.threshold:
+            regressions.append(name)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
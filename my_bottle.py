@@ -2,22 +2,41 @@
 # -*- coding:utf-8 -*-
 
 from urllib import parse
-import cgi
 import mimetypes
 import os
 import sys
 import traceback
 import re
-import random
 import http.cookies
 import threading
+import contextvars
+import asyncio
+import queue
+import socket
+import signal
+import inspect
 import time
+import itertools
 import builtins
+import contextlib
+import bisect
+import mmap
+import hashlib
+import importlib.util
+import marshal
+import json
+import io
+import tempfile
+import gzip
+import email.utils
+from stat import S_ISREG, S_ISSOCK
+import ast
+from collections import OrderedDict
 
 try:
     from urlparse import parse_qs
 except ImportError:
-    from cgi import parse_qs
+    from urllib.parse import parse_qs
 
 
 # 异常和事件
@@ -60,54 +79,414 @@ def WSGIHandler(environ, start_response):
     :param environ: 环境变量
     :param start_response: 响应
     """
-    global request
-    global response
+    started = time.perf_counter()
+    metrics = METRICS
+    series = route = None
+    request, response = bind_context(environ)
+    timings = request._timings
+    try:
+        try:
+            handler, args, route = match_route(request.path, request.method)
+            if timings is not None:
+                mark = time.perf_counter()
+                timings['match'] = mark - started
+            if metrics is not None:
+                series = metrics.begin(request.method, route)
+            try:
+                output = cast_output(handler(**args))
+            finally:
+                if timings is not None:
+                    # 处理器阶段包含其中的请求体解析和模板渲染阶段，
+                    # 以 abort()、redirect()、send_file() 或异常结束的处理器同样记录
+                    timings['handler'] = time.perf_counter() - mark
+        except BreakTheBottle as shard:
+            output = cast_output(shard.output)
+    except Exception as exception:
+        output = handle_error(exception)
+
+    output = finish_output(output)
+    if metrics is not None:
+        output = metrics.observe(series, started, output)
+    if timings is not None:
+        output = finish_timing(timings, started, route, output)
+    if hasattr(output, 'read'):
+        # 服务器提供 wsgi.file_wrapper 时交给服务器发送，通常可以直接使用 os.sendfile
+        output = environ.get('wsgi.file_wrapper', FileWrapper)(output)
+
+    status = '%d %s' % (response.status, HTTP_CODES[response.status])
+    start_response(status, list(response.header.items()))
+    return output
+
+
+async def ASGIHandler(scope, receive, send):
+    """
+    自定义 ASGI Handler
+    与 WSGIHandler 共用路由、错误处理器和响应处理流程，处理器可以是 async def 函数
+    request 和 response 保存在 contextvars 中，并发的协程之间互不影响
+    :param scope: 连接信息
+    :param receive: 接收消息的协程函数
+    :param send: 发送消息的协程函数
+    """
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        raise BottleException('Unsupported ASGI scope type: %s' % scope['type'])
+
+    metrics = METRICS
+    if metrics is not None:
+        started = time.perf_counter()
+        series = None
+    environ = asgi_environ(scope)
+    request, response = bind_context(environ)
+    try:
+        try:
+            environ['wsgi.input'] = await receive_body(receive)
+            handler, args, route = match_route(request.path, request.method)
+            if metrics is not None:
+                series = metrics.begin(request.method, route)
+            output = handler(**args)
+            if inspect.isawaitable(output):
+                output = await output
+            if hasattr(output, '__aiter__'):
+                output = await cast_async_output(output)
+            else:
+                output = cast_output(output)
+        except BreakTheBottle as shard:
+            output = cast_output(shard.output)
+    except Exception as exception:
+        output = handle_error(exception)
+
+    output = finish_output(output)
+    headers = [(key.lower().encode('latin1'), value.encode('latin1')) for key, value in response.header.items()]
+    status = response.status
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    size = 0
+    try:
+        if request.method == 'HEAD':
+            # 与 wsgiref 服务器相同，HEAD 请求只发送响应头，不读取文件也不迭代响应体
+            pass
+        elif hasattr(output, '__aiter__'):
+            async for chunk in output:
+                size += len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        elif hasattr(output, 'read'):
+            loop = asyncio.get_running_loop()
+            while True:
+                chunk = await loop.run_in_executor(None, output.read, 65536)
+                if not chunk:
+                    break
+                size += len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        else:
+            for chunk in output:
+                size += len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        if hasattr(output, 'aclose'):
+            await output.aclose()
+        elif hasattr(output, 'close'):
+            output.close()
+        if metrics is not None:
+            metrics.record(metrics.begin(*metrics.UNMATCHED) if series is None else series, status, started, size)
+
+
+def bind_context(environ):
+    """
+    为当前线程或 asyncio 任务创建新的请求和响应对象，返回 (request, response)
+    """
+    request, response = Request(), Response()
     request.bind(environ)
     response.bind()
+    REQUEST_CONTEXT.set(request)
+    RESPONSE_CONTEXT.set(response)
+    return request, response
+
+
+def asgi_environ(scope):
+    """
+    根据 ASGI 的 scope 构造 WSGI 风格的环境变量字典，使 Request 可以同时用于两种协议
+    """
+    server = scope.get('server') or ('127.0.0.1', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        # 请求体已经由服务器解码并在 receive_body() 中缓存，直接读到结尾即可
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'asgi.scope': scope,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin1')
+        if name in environ:
+            # HTTP/2 把每个 cookie 作为单独的标头发送，需要以 '; ' 连接，其他标头以 ',' 连接
+            value = environ[name] + ('; ' if name == 'HTTP_COOKIE' else ',') + value
+        environ[name] = value
+    return environ
+
+
+async def receive_body(receive):
+    """
+    接收 ASGI 请求体，超过 MEMFILE_MAX 字节后保存在临时文件中
+    超过 MAX_BODY_SIZE 字节时抛出 HTTPError(413)
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=MEMFILE_MAX)
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            break
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_BODY_SIZE:
+            abort(413, 'Request body too large.')
+        body.write(chunk)
+        if not message.get('more_body', False):
+            break
+    body.seek(0)
+    return body
+
+
+async def cast_async_output(output):
+    """
+    与 cast_output() 相同，用于异步生成器：先取出第一个片段，之后逐个编码
+    """
+    response = RESPONSE_CONTEXT.get()
+    iterator = output.__aiter__()
     try:
-        handler, args = match_url(request.path, request.method)
-        output = handler(**args)
-    except BreakTheBottle as shard:
-        output = shard.output
-    except Exception as exception:
-        response.status = getattr(exception, 'http_status', 500)
-        error_handler = ERROR_HANDLER.get(response.status, None)
-        if error_handler:
+        first = await iterator.__anext__()
+    except StopAsyncIteration:
+        return cast_output(b'')
+    charset = response.charset
+
+    async def encode():
+        chunk = first
+        while True:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            if chunk:
+                yield chunk
             try:
-                output = error_handler(exception)
-            except:
-                output = 'Exception within error handler! Application stopped.'
-        else:
-            if DEBUG:
-                output = 'Exception %s: %s' % (exception.__class__.__name__, str(exception))
-            else:
-                output = 'Unhandled exception: Application stopped.'
+                chunk = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
 
-        if response.status == 500:
-            request._environ['wsgi.errors'].write("Error (500) on '%s': %s\n" % (request.path, exception))
+    return encode()
 
-    if hasattr(output, 'fileno') and 'Content-Length' not in response.header:
-        size = os.fstat(output.filenp()).st_size
-        response.header['Content-Length'] = size
 
-    if hasattr(output, 'read'):
-        file_output = output
-        if 'wsgi.file_wrapper' in environ:
-            output = environ['wsgi.file_wrapper'](file_output)
-        else:
-            output = iter(lambda: file_output.read(8192), '')
+def finish_output(output):
+    """
+    WSGI 和 ASGI 共用的响应处理流程：压缩、文件长度和 Set-Cookie 标头
+    """
+    response = RESPONSE_CONTEXT.get()
+    if GZIP_MIN_SIZE is not None:
+        output = compress_output(output)
+
+    if hasattr(output, 'fileno') and 'Content-Length' not in response.header:
+        try:
+            size = os.fstat(output.fileno()).st_size - output.tell()
+            response.header['Content-Length'] = size
+        except (OSError, ValueError, io.UnsupportedOperation):
+            pass
 
     for c in response.COOKIES.values():
         response.header.add('Set-Cookie', c.OutputString())
+    return output
 
-    status = '%d %s' % (response.status, HTTP_CODES[response.status])
-    start_response(status, list(response.header.items()))
+
+def handle_error(exception):
+    """
+    设置错误状态码并调用对应的错误处理器，返回转换后的响应内容
+    """
+    request, response = REQUEST_CONTEXT.get(), RESPONSE_CONTEXT.get()
+    response.status = getattr(exception, 'http_status', 500)
+    # 错误页面替换了原来的响应内容，原来的长度不再有效
+    if 'Content-Length' in response.header:
+        del response.header['Content-Length']
+    error_handler = ERROR_HANDLER.get(response.status, None)
+    output = None
+    if error_handler:
+        try:
+            output = cast_output(error_handler(exception))
+        except:
+            output = cast_output('Exception within error handler! Application stopped.')
+    else:
+        if DEBUG:
+            output = cast_output('Exception %s: %s' % (exception.__class__.__name__, str(exception)))
+        else:
+            output = cast_output('Unhandled exception: Application stopped.')
+
+    if response.status == 500:
+        request._environ['wsgi.errors'].write("Error (500) on '%s': %s\n" % (request.path, exception))
     return output
 
 
-class Request(threading.local):
+def cast_output(output):
+    """
+    把 handler 的返回值转换为 WSGI 服务器可以直接使用的字节串可迭代对象
+
+    字符串按照 Content-Type 中的 charset（默认 utf-8）只编码一次，
+    字符串、字节串以及它们组成的元组合并为一个片段并计算 Content-Length，
+    字典和列表（包括空列表和字符串列表）一律由 JSON_ENCODER 序列化为 JSON，
+    需要分片输出的响应体使用元组或生成器，
+    迭代器先取出第一个片段，使其中的异常在 start_response() 之前被处理，
+    文件对象原样返回，由 WSGIHandler 交给 wsgi.file_wrapper
+    """
+    response = RESPONSE_CONTEXT.get()
+    if output is None:
+        output = b''
+    if isinstance(output, (dict, list)):
+        output = json_output(output)
+    if isinstance(output, (str, bytes)):
+        output = (output,)
+    if isinstance(output, tuple) and all(isinstance(chunk, (str, bytes)) for chunk in output):
+        charset = response.charset
+        body = b''.join(chunk.encode(charset) if isinstance(chunk, str) else chunk for chunk in output)
+        if 'Content-Length' not in response.header and response.status not in (204, 304):
+            response.header['Content-Length'] = len(body)
+        return [body] if body else []
+    if hasattr(output, 'read'):
+        return output
+    if inspect.iscoroutine(output) or hasattr(output, '__aiter__'):
+        if inspect.iscoroutine(output):
+            # 避免 "coroutine was never awaited" 警告
+            output.close()
+        raise BottleException('Handler returned %s; async def handlers need an ASGI server such as AsyncioServer.'
+                              % type(output).__name__)
+
+    iterator = iter(output)
+    try:
+        first = next(iterator)
+    except StopIteration:
+        if hasattr(output, 'close'):
+            output.close()
+        return cast_output(b'')
+    return OutputIterator(first, iterator, output, response.charset)
+
+
+def json_output(obj):
+    """
+    把字典或列表序列化为 JSON 并设置 Content-Type
+    元素超过 JSON_STREAM_SIZE 个的列表逐个元素编码，按大约 64KB 的片段流式输出
+    """
+    response = RESPONSE_CONTEXT.get()
+    if response.header.get('Content-Type') == DEFAULT_CONTENT_TYPE:
+        response.content_type = 'application/json'
+    if not isinstance(obj, list) or len(obj) <= JSON_STREAM_SIZE:
+        return JSON_ENCODER.encode(obj)
+
+    def stream(items, encode):
+        buffer, size = ['['], 1
+        for i, item in enumerate(items):
+            data = encode(item)
+            if isinstance(data, bytes):
+                data = data.decode('utf-8')
+            buffer.append(data if i == 0 else ',' + data)
+            size += len(data) + 1
+            if size >= 65536:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+        buffer.append(']')
+        yield ''.join(buffer)
+
+    return stream(obj, JSON_ENCODER.encode)
+
+
+class OutputIterator(object):
+    """
+    逐个编码 handler 产出的片段
+    服务器调用 close() 时关闭原始的可迭代对象（例如生成器）
+    """
+
+    def __init__(self, first, iterator, output, charset):
+        self.first = first
+        self.iterator = iterator
+        self.charset = charset
+        if hasattr(output, 'close'):
+            self.close = output.close
+
+    def __iter__(self):
+        charset = self.charset
+        first, self.first = self.first, None
+        for chunk in itertools.chain((first,), self.iterator):
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            if chunk:
+                yield chunk
+
+
+class ContextLocal(object):
+    """
+    当前线程或 asyncio 任务绑定的对象的代理，模块级的 request 和 response 都是这样的代理
+    每个请求由 bind() 创建一个新的对象保存在 ContextVar 中，访问属性时只需要一次 ContextVar.get()，
+    并发的线程和协程之间互不影响。框架内部的热点函数直接从 ContextVar 取得对象，不经过代理
+    """
+    __slots__ = ('_factory', '_context_var')
+
+    def __init__(self, factory, context_var):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_context_var', context_var)
+
+    def bind(self, *args):
+        """
+        创建一个新的对象并绑定到当前线程或任务，返回这个对象
+        """
+        # 代理自身的属性也要经过 __getattribute__，直接读取可以省去一次函数调用
+        get = object.__getattribute__
+        obj = get(self, '_factory')()
+        obj.bind(*args)
+        get(self, '_context_var').set(obj)
+        return obj
+
+    def _current(self):
+        get = object.__getattribute__
+        try:
+            return get(self, '_context_var').get()
+        except LookupError:
+            # 还没有绑定过的线程或任务得到一个未绑定的对象
+            obj = get(self, '_factory')()
+            get(self, '_context_var').set(obj)
+            return obj
+
+    def __getattribute__(self, name):
+        if name in ContextLocal.__dict__:
+            return object.__getattribute__(self, name)
+        try:
+            obj = object.__getattribute__(self, '_context_var').get()
+        except LookupError:
+            obj = ContextLocal._current(self)
+        return getattr(obj, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._current(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._current(), name)
+
+    def __repr__(self):
+        return '<%s proxy %r>' % (self._factory.__name__, self._current())
+
+
+class Request(object):
     """
-    使用 thread-local 命名空间来表示一个单独的请求
+    表示一个单独的请求，每个请求由 request.bind() 创建一个新的对象
     """
 
     def bind(self, environ):
@@ -120,6 +499,10 @@ class Request(threading.local):
         self._POST = None
         self._GETPOST = None
         self._COOKIES = None
+        self._body = None
+        self._body_consumed = False
+        # 启用计时后记录各个处理阶段的耗时 {阶段名: 秒}
+        self._timings = {} if SERVER_TIMING or SLOW_REQUEST_THRESHOLD is not None else None
         self.path = self._environ.get('PATH_INFO', '/').strip()
         if not self.path.startswith('/'):
             self.path = '/' + self.path
@@ -167,19 +550,117 @@ class Request(threading.local):
     def POST(self):
         """
         返回 POST 方法的参数字典
+        支持 application/x-www-form-urlencoded 和 multipart/form-data，
+        上传的文件以 FileUpload 对象表示，同名参数的值合并为列表
         """
         if self._POST is None:
-            raw_data = cgi.FieldStorage(fp=self._environ['wsgi.input'], environ=self._environ)
-            self._POST = {}
-            for key in raw_data:
-                if raw_data[key].filename:
-                    self._POST[key] = raw_data[key]
-                elif isinstance(raw_data[key], list):
-                    self._POST[key] = [v.value for v in raw_data[key]]
-                else:
-                    self._POST[key] = raw_data[key].value
+            with self.timer('body'):
+                self._POST = self._parse_post()
         return self._POST
 
+    def _parse_post(self):
+        if self.input_length > MAX_BODY_SIZE:
+            abort(413, 'Request body too large.')
+        content_type, params = parse_header_params(self._environ.get('CONTENT_TYPE', ''))
+        chunks = self.iter_body()
+        if content_type == 'multipart/form-data' and params.get('boundary'):
+            items = parse_multipart(chunks, params['boundary'], params.get('charset', 'utf-8'))
+        elif content_type == 'application/x-www-form-urlencoded':
+            body, size = [], 0
+            for chunk in chunks:
+                body.append(chunk)
+                size += len(chunk)
+                if size > MAX_FIELD_SIZE:
+                    abort(413, 'Form data too large.')
+            items = parse.parse_qsl(b''.join(body).decode(params.get('charset', 'utf-8'), 'replace'),
+                                    keep_blank_values=True)
+        else:
+            items = []
+        post = {}
+        for key, value in items:
+            if key not in post:
+                post[key] = value
+            elif isinstance(post[key], list):
+                post[key].append(value)
+            else:
+                post[key] = [post[key], value]
+        return post
+
+    def timer(self, name):
+        """
+        记录一个处理阶段耗时的上下文管理器，同名阶段的耗时累加
+        没有启用 SERVER_TIMING 或 SLOW_REQUEST_THRESHOLD 时什么也不做
+        例如：
+            with request.timer('db'):
+                rows = query()
+        """
+        timings = getattr(self, '_timings', None)
+        if timings is None:
+            return NULL_TIMER
+        return PhaseTimer(timings, name)
+
+    @property
+    def chunked(self):
+        """
+        请求体是否使用 Transfer-Encoding: chunked 传输
+        """
+        return 'chunked' in self._environ.get('HTTP_TRANSFER_ENCODING', '').lower()
+
+    def iter_body(self, chunk_size=65536):
+        """
+        分块迭代请求体，内存占用与请求体大小无关
+        遵守 CONTENT_LENGTH，并解码 Transfer-Encoding: chunked
+        请求体只能从 wsgi.input 读取一次，需要多次读取时请使用 body
+        """
+        if self._body is not None:
+            self._body.seek(0)
+            return iter(lambda: self._body.read(chunk_size), b'')
+        if self._body_consumed:
+            raise BottleException('Request body has already been consumed.')
+        self._body_consumed = True
+        stream = self._environ['wsgi.input']
+        if self._environ.get('wsgi.input_terminated'):
+            # 服务器已经处理了分块编码或请求体长度，直接读到结尾
+            return iter(lambda: stream.read(chunk_size), b'')
+        if self.chunked:
+            return iter_chunked(stream, chunk_size)
+        return iter_input(stream, self.input_length, chunk_size)
+
+    def iter_lines(self, chunk_size=65536, keepends=False):
+        """
+        按行迭代请求体（例如 NDJSON），每一行为字节串
+        """
+        rest = b''
+        for chunk in self.iter_body(chunk_size):
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line + b'\n' if keepends else line.rstrip(b'\r')
+        if rest:
+            yield rest
+
+    @property
+    def body(self):
+        """
+        返回包含整个请求体的类文件对象
+        请求体第一次访问时读入，超过 MEMFILE_MAX 字节后保存在临时文件中，
+        超过 MAX_BODY_SIZE 字节时抛出 HTTPError(413)
+        """
+        if self._body is None:
+            if self.input_length > MAX_BODY_SIZE:
+                abort(413, 'Request body too large.')
+            body = tempfile.SpooledTemporaryFile(max_size=MEMFILE_MAX)
+            size = 0
+            with self.timer('body'):
+                for chunk in self.iter_body():
+                    size += len(chunk)
+                    if size > MAX_BODY_SIZE:
+                        abort(413, 'Request body too large.')
+                    body.write(chunk)
+            self._body = body
+        self._body.seek(0)
+        return self._body
+
     @property
     def params(self):
         """
@@ -203,19 +684,19 @@ class Request(threading.local):
         return self._COOKIES
 
 
-class Response(threading.local):
+class Response(object):
     """
-    使用 thread-local 命名空间来表示一个单独的响应
+    表示一个单独的响应，每个请求由 response.bind() 创建一个新的对象
     """
 
     def bind(self):
         """
-        清除旧数据，创建一个新的响应对象
+        设置响应的初始状态
         """
         self._COOKIES = None
         self.status = 200
         self.header = HeaderDict()
-        self.content_type = 'text/html'
+        self.content_type = DEFAULT_CONTENT_TYPE
         self.error = None
 
     @property
@@ -245,6 +726,13 @@ class Response(threading.local):
 
     content_type = property(get_content_type, set_content_type, None, get_content_type.__doc__)
 
+    @property
+    def charset(self):
+        """
+        Content-Type 中声明的字符集，默认为 utf-8
+        """
+        return parse_header_params(self.header.get('Content-Type') or '')[1].get('charset', 'utf-8')
+
 
 # 类定义
 
@@ -266,6 +754,9 @@ class HeaderDict(dict):
     def __contains__(self, item):
         return dict.__contains__(self, item.title())
 
+    def get(self, key, default=None):
+        return dict.get(self, key.title(), default)
+
     def items(self):
         """
         返回一个 (key, value) 元组的列表
@@ -292,6 +783,218 @@ class HeaderDict(dict):
             self[key] = [value]
 
 
+class LRUCache(object):
+    """
+    线程安全的有界 LRU 缓存
+    maxsize 为 0 时禁用缓存，hits / misses / evictions 用于评估缓存大小
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = int(maxsize)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+        返回缓存的值并标记为最近使用，不存在时返回 default
+        """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        添加一个缓存项，超出容量时淘汰最久未使用的项
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """
+        删除一个缓存项并返回它的值
+        """
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        """
+        清空缓存，统计计数保持不变
+        """
+        with self._lock:
+            self._data.clear()
+
+    def resize(self, maxsize):
+        """
+        调整缓存容量，多出的项立即被淘汰
+        """
+        with self._lock:
+            self.maxsize = int(maxsize)
+            while len(self._data) > max(self.maxsize, 0):
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """
+        返回缓存统计信息字典
+        """
+        return {'size': len(self._data), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class FragmentCache(LRUCache):
+    """
+    模板片段缓存，保存 '% cache key, ttl' 语句块的渲染结果
+    ttl 为 None 时片段只会因为 LRU 淘汰或 clear() 失效
+    """
+
+    @staticmethod
+    def parse_args(key, ttl=None):
+        return key, ttl
+
+    def get_fragment(self, key):
+        """
+        返回未过期的片段内容，否则返回 None
+        """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        expires, text = entry
+        if expires is not None and expires < time.time():
+            self.pop(key)
+            return None
+        return text
+
+    def set_fragment(self, key, text, ttl=None):
+        """
+        保存片段内容，ttl 单位为秒
+        """
+        expires = time.time() + ttl if ttl is not None else None
+        self.put(key, (expires, text))
+
+
+class FileWrapper(object):
+    """
+    wsgi.file_wrapper 的后备实现，按块读取文件内容
+    服务器适配器可以通过 filelike 取得文件对象并使用 os.sendfile 发送
+    """
+
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        read = self.filelike.read
+        blksize = self.blksize
+        while True:
+            data = read(blksize)
+            if not data:
+                break
+            yield data
+
+
+class FileRange(object):
+    """
+    文件中从 offset 开始的 length 个字节
+    read() 不会越过范围末尾，fileno() 和 tell() 使 os.sendfile 可以直接发送这段内容
+    """
+
+    def __init__(self, fp, offset, length):
+        self.fp = fp
+        self.fp.seek(offset)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fp.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def tell(self):
+        return self.fp.tell()
+
+    def seek(self, offset):
+        self.remaining -= offset - self.fp.tell()
+        self.fp.seek(offset)
+
+    def close(self):
+        self.fp.close()
+
+
+def sendfile(sock, filelike, count=None):
+    """
+    使用 socket.sendfile 在内核中把文件内容直接发送到套接字，返回发送的字节数
+    count 为 None 时发送到文件（或 FileRange）末尾，文件对象不支持 fileno() 时返回 None
+    设置了超时的套接字处于非阻塞模式，socket.sendfile 在发送缓冲区满时会等待套接字可写
+    """
+    try:
+        filelike.fileno()
+        offset = filelike.tell()
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return None
+    if count is None:
+        count = getattr(filelike, 'remaining', None)
+    if count == 0:
+        return 0
+    return sock.sendfile(filelike, offset, count)
+
+
+class FileUpload(object):
+    """
+    multipart/form-data 中上传的文件
+    内容较小时保存在内存中，超过 MEMFILE_MAX 字节后写入临时文件
+    """
+
+    def __init__(self, name, filename, content_type, headers):
+        self.name = name
+        self.filename = filename
+        self.type = content_type
+        self.headers = headers
+        self.size = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=MEMFILE_MAX)
+
+    def write(self, data):
+        self.size += len(data)
+        self.file.write(data)
+
+    @property
+    def value(self):
+        """
+        以字节串返回全部文件内容
+        """
+        self.file.seek(0)
+        return self.file.read()
+
+    def __repr__(self):
+        return '<FileUpload %s: %s (%d bytes)>' % (self.name, self.filename, self.size)
+
+
 # 辅助方法
 def abort(code=500, text='Unknown Error: Application stopped.'):
     """
@@ -309,19 +1012,25 @@ def redirect(url, code=307):
     raise BreakTheBottle("")
 
 
-def send_file(filename, root, guessmime=True, mimetype='text/plain'):
+def send_file(filename, root, guessmime=True, mimetype='text/plain', weak_etag=False, precompressed=True):
     """
     中止执行并发送一个静态文件作为响应
+
+    支持 ETag / If-None-Match / If-Modified-Since 条件请求，以及 Range 部分请求
+    weak_etag 为 True 时发送弱 ETag，弱 ETag 不能用于 If-Range
+    precompressed 为 True 时，如果客户端接受并且存在 foo.js.br / foo.js.gz，则直接发送压缩文件
     """
+    request, response = REQUEST_CONTEXT.get(), RESPONSE_CONTEXT.get()
     root = os.path.abspath(root) + '/'
     filename = os.path.normpath(filename).strip('/')
     filename = os.path.join(root, filename)
 
     if not filename.startswith(root):
         abort(401, "Access denied.")
-    if not os.path.exists(filename) or not os.path.isfile(filename):
+    stats, readable = stat_file(filename)
+    if stats is None or not S_ISREG(stats.st_mode):
         abort(404, "File does not exist.")
-    if not os.access(filename, os.R_OK):
+    if not readable:
         abort(401, "You do not have permission to access this file.")
 
     if guessmime:
@@ -333,19 +1042,394 @@ def send_file(filename, root, guessmime=True, mimetype='text/plain'):
     elif mimetype:
         response.content_type = mimetype
 
-    stats = os.stat(filename)
-    if 'Content-Length' not in response.header:
+    if precompressed:
+        accepted = None
+        for coding, ext in PRECOMPRESSED:
+            sibling_stats, sibling_readable = stat_file(filename + ext)
+            if sibling_stats is None or not S_ISREG(sibling_stats.st_mode):
+                continue
+            # 存在压缩版本时，响应内容取决于 Accept-Encoding
+            add_vary(response.header, 'Accept-Encoding')
+            if accepted is None:
+                accepted = parse_accept_encoding(request._environ.get('HTTP_ACCEPT_ENCODING', ''))
+            if sibling_readable and accepts_encoding(accepted, coding):
+                filename, stats = filename + ext, sibling_stats
+                response.header['Content-Encoding'] = coding
+                break
+
+    def set_validators(stats):
+        etag = '"%x-%x-%x"' % (stats.st_ino, stats.st_size, stats.st_mtime_ns)
+        response.header['ETag'] = 'W/' + etag if weak_etag else etag
+        response.header['Last-Modified'] = email.utils.formatdate(stats.st_mtime, usegmt=True)
+
+    set_validators(stats)
+    if request.method in ('GET', 'HEAD') and not_modified(response.header['ETag'], stats.st_mtime):
+        response.status = 304
+        raise BreakTheBottle(b'')
+
+    fp = open(filename, 'rb')
+    fresh = os.fstat(fp.fileno())
+    if (fresh.st_mtime_ns, fresh.st_size, fresh.st_ino) != (stats.st_mtime_ns, stats.st_size, stats.st_ino):
+        # 缓存的文件状态已经过期，以实际打开的文件为准
+        stats = fresh
+        STAT_CACHE.put(filename, (time.time(), stats, True))
+        set_validators(stats)
+
+    response.header['Accept-Ranges'] = 'bytes'
+    ranges = None
+    if 'HTTP_RANGE' in request._environ and request.method in ('GET', 'HEAD'):
+        if_range = request._environ.get('HTTP_IF_RANGE')
+        strong_etag = None if weak_etag else response.header['ETag']
+        if not if_range or if_range in (response.header['Last-Modified'], strong_etag):
+            ranges = parse_range_header(request._environ['HTTP_RANGE'], stats.st_size)
+
+    if ranges is None:
         response.header['Content-Length'] = stats.st_size
+        raise BreakTheBottle(fp)
+
+    if not ranges:
+        fp.close()
+        response.status = 416
+        response.header['Content-Range'] = 'bytes */%d' % stats.st_size
+        response.header['Content-Length'] = 0
+        raise BreakTheBottle(b'')
+
+    response.status = 206
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        response.header['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, stats.st_size)
+        response.header['Content-Length'] = end - start
+        raise BreakTheBottle(FileRange(fp, start, end - start))
+
+    boundary = hashlib.md5(('%s:%f' % (filename, time.time())).encode('utf-8')).hexdigest()
+    part_headers = []
+    length = 0
+    for start, end in ranges:
+        head = ('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+            boundary, response.content_type, start, end - 1, stats.st_size)).encode('latin1')
+        part_headers.append(head)
+        length += len(head) + end - start + 2
+    tail = ('--%s--\r\n' % boundary).encode('latin1')
+    response.header['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+    response.header['Content-Length'] = length + len(tail)
+
+    def multipart_output(fp):
+        with fp:
+            for head, (start, end) in zip(part_headers, ranges):
+                yield head
+                for data in FileWrapper(FileRange(fp, start, end - start), 65536):
+                    yield data
+                yield b'\r\n'
+            yield tail
+
+    raise BreakTheBottle(multipart_output(fp))
+
+
+def stat_file(filename):
+    """
+    返回文件的 (os.stat 结果, 是否可读)，文件不存在时返回 (None, False)
+    结果在 STAT_CACHE 中缓存 STAT_CACHE_TTL 秒，热点静态文件不需要每次都访问文件系统
+    """
+    now = time.time()
+    entry = STAT_CACHE.get(filename)
+    if entry is not None and now - entry[0] < STAT_CACHE_TTL:
+        return entry[1], entry[2]
+    try:
+        stats = os.stat(filename)
+    except OSError:
+        stats = None
+    readable = stats is not None and os.access(filename, os.R_OK)
+    STAT_CACHE.put(filename, (now, stats, readable))
+    return stats, readable
+
+
+def iter_input(stream, length, chunk_size=65536):
+    """
+    按固定大小分块读取 wsgi.input，最多读取 length 个字节
+    """
+    while length > 0:
+        data = stream.read(min(chunk_size, length))
+        if not data:
+            break
+        length -= len(data)
+        yield data
+
+
+def iter_chunked(stream, chunk_size=65536):
+    """
+    解码 Transfer-Encoding: chunked 编码的请求体，按块产出数据
+    """
+    while True:
+        line = stream.readline(1024)
+        try:
+            size = int(line.split(b';')[0].strip(), 16)
+        except ValueError:
+            abort(400, 'Invalid chunk size in chunked request body.')
+        if size == 0:
+            # 跳过可能存在的 trailer 标头
+            while stream.readline(65536) not in (b'\r\n', b'\n', b''):
+                pass
+            return
+        while size > 0:
+            data = stream.read(min(chunk_size, size))
+            if not data:
+                abort(400, 'Unexpected end of chunked request body.')
+            size -= len(data)
+            yield data
+        if stream.readline(1024) not in (b'\r\n', b'\n'):
+            abort(400, 'Invalid chunk terminator in chunked request body.')
+
+
+def parse_header_params(value):
+    """
+    解析 'text/html; charset=utf-8' 形式的标头，返回 (小写的主值, 参数字典)
+    """
+    main, _, rest = value.partition(';')
+    params = {}
+    for match in re.finditer(r';\s*([\w\-.*]+)\s*=\s*("(?:\\.|[^"])*"|[^;]*)', ';' + rest):
+        key, val = match.group(1).lower(), match.group(2).strip()
+        if val.startswith('"') and val.endswith('"') and len(val) > 1:
+            val = re.sub(r'\\(.)', r'\1', val[1:-1])
+        params[key] = val
+    return main.strip().lower(), params
+
+
+def parse_multipart(chunks, boundary, charset='utf-8'):
+    """
+    增量解析 multipart/form-data 请求体，chunks 为字节串迭代器
+    返回 (name, value) 列表，普通字段的值为字符串，文件为 FileUpload 对象
+
+    普通字段超过 MAX_FIELD_SIZE、文件超过 MAX_PART_SIZE、
+    请求体超过 MAX_BODY_SIZE 或者分段超过 MAX_PARTS 个时抛出 HTTPError(413)
+    """
+    delimiter = b'\r\n--' + boundary.encode('latin1')
+    buf = b'\r\n'
+    total = 0
+    chunks = iter(chunks)
+
+    def fill():
+        nonlocal buf, total
+        data = next(chunks, b'')
+        if not data:
+            abort(400, 'Unexpected end of multipart data.')
+        total += len(data)
+        if total > MAX_BODY_SIZE:
+            abort(413, 'Request body too large.')
+        buf += data
+
+    # 跳过第一个分隔符之前的内容
+    while True:
+        pos = buf.find(delimiter)
+        if pos >= 0:
+            buf = buf[pos + len(delimiter):]
+            break
+        buf = buf[-len(delimiter):]
+        fill()
+
+    items = []
+    while True:
+        while len(buf) < 2:
+            fill()
+        if buf.startswith(b'--'):
+            return items
+        if len(items) >= MAX_PARTS:
+            abort(413, 'Too many parts in multipart data.')
+
+        # 分段标头
+        while b'\r\n\r\n' not in buf:
+            if len(buf) > 16384:
+                abort(400, 'Multipart headers too large.')
+            fill()
+        head, buf = buf.split(b'\r\n\r\n', 1)
+        headers = HeaderDict()
+        for line in head.decode('utf-8', 'replace').split('\r\n')[1:]:
+            key, _, value = line.partition(':')
+            if key.strip():
+                headers[key.strip()] = value.strip()
+        disposition, params = parse_header_params(headers.get('Content-Disposition', ''))
+        name = params.get('name', '')
+        part_type, type_params = parse_header_params(headers.get('Content-Type', 'text/plain'))
+        if 'filename' in params:
+            part = FileUpload(name, params['filename'], part_type, headers)
+            limit = MAX_PART_SIZE
+        else:
+            part = []
+            limit = MAX_FIELD_SIZE
+
+        # 分段内容，缓冲区末尾可能是被截断的分隔符，需要保留
+        size = 0
+        while True:
+            pos = buf.find(delimiter)
+            if pos >= 0:
+                data, buf = buf[:pos], buf[pos + len(delimiter):]
+            else:
+                keep = len(delimiter) - 1
+                data, buf = buf[:-keep], buf[-keep:]
+            size += len(data)
+            if size > limit:
+                abort(413, 'Multipart field "%s" too large.' % name)
+            if data and isinstance(part, list):
+                part.append(data)
+            elif data:
+                part.write(data)
+            if pos >= 0:
+                break
+            fill()
+
+        if isinstance(part, list):
+            items.append((name, b''.join(part).decode(type_params.get('charset', charset), 'replace')))
+        else:
+            part.file.seek(0)
+            items.append((name, part))
+
+
+def parse_accept_encoding(header):
+    """
+    解析 Accept-Encoding 标头，返回 {编码: q 值} 字典
+    """
+    accepted = {}
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def accepts_encoding(accepted, coding):
+    """
+    判断客户端是否接受某种内容编码，accepted 为 parse_accept_encoding() 的结果
+    """
+    if coding in accepted:
+        return accepted[coding] > 0
+    return accepted.get('*', 0) > 0
+
+
+def add_vary(header, field):
+    """
+    把 field 合并到 Vary 标头中，保留处理器已经设置的值（例如 Vary: Cookie）
+    """
+    value = header.get('Vary')
+    if isinstance(value, list):
+        value = ', '.join(value)
+    fields = [item.strip() for item in value.split(',') if item.strip()] if value else []
+    if '*' in fields or field.lower() in [item.lower() for item in fields]:
+        return
+    header['Vary'] = ', '.join(fields + [field])
 
-    if 'Last-Modified' not in response.header:
-        ts = time.gmtime(stats.st_mtime)
-        ts = time.strftime("%a, %d %b %Y %H:%M:%S +0000", ts)
-        response.header['Last-Modified'] = ts
 
-    raise BreakTheBottle(open(filename, 'r'))
+def compress_output(output):
+    """
+    响应压缩阶段：客户端接受 gzip 时压缩超过 GZIP_MIN_SIZE 字节的文本响应
+    只处理 cast_output() 合并后的单个片段，文件和迭代器原样返回
+    相同内容的压缩结果保存在 GZIP_CACHE 中
+    """
+    request, response = REQUEST_CONTEXT.get(), RESPONSE_CONTEXT.get()
+    if not (isinstance(output, list) and len(output) == 1 and isinstance(output[0], bytes)):
+        return output
+    if response.status != 200 or 'Content-Encoding' in response.header:
+        return output
+    content_type = (response.header.get('Content-Type') or '').split(';')[0].strip().lower()
+    if not content_type.startswith(GZIP_CONTENT_TYPES):
+        return output
+    accepted = parse_accept_encoding(request._environ.get('HTTP_ACCEPT_ENCODING', ''))
+    add_vary(response.header, 'Accept-Encoding')
+    if not accepts_encoding(accepted, 'gzip'):
+        return output
+
+    body = output[0]
+    if len(body) < GZIP_MIN_SIZE:
+        return output
+
+    key = hashlib.sha1(body).digest()
+    compressed = GZIP_CACHE.get(key)
+    if compressed is None:
+        compressed = gzip.compress(body, GZIP_LEVEL, mtime=0)
+        GZIP_CACHE.put(key, compressed)
+    response.header['Content-Encoding'] = 'gzip'
+    response.header['Content-Length'] = len(compressed)
+    return [compressed]
+
+
+def not_modified(etag, mtime):
+    """
+    根据 If-None-Match 和 If-Modified-Since 判断客户端缓存是否仍然有效
+    同时存在时只使用 If-None-Match
+    """
+    if_none_match = request._environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        if if_none_match.strip() == '*':
+            return True
+        # If-None-Match 使用弱比较，忽略 W/ 前缀
+        etag = etag[2:] if etag.startswith('W/') else etag
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if (tag[2:] if tag.startswith('W/') else tag) == etag:
+                return True
+        return False
+    if_modified_since = request._environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+        since = email.utils.parsedate_tz(if_modified_since.split(';')[0].strip())
+        if since is not None:
+            return int(mtime) <= email.utils.mktime_tz(since)
+    return False
+
+
+def parse_range_header(header, size):
+    """
+    解析 Range 标头，返回按顺序排列且不重叠的 [start, end) 列表
+    格式错误时返回 None（忽略 Range 标头），所有范围都无法满足时返回空列表
+    """
+    unit, _, value = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    try:
+        for spec in value.split(','):
+            first, _, last = spec.strip().partition('-')
+            if not _:
+                return None
+            if not first:
+                # 后缀范围 -n 表示最后 n 个字节
+                start, end = max(size - int(last), 0), size
+            else:
+                start = int(first)
+                end = min(int(last) + 1, size) if last else size
+                if last and int(last) < start:
+                    return None
+            if start < end:
+                ranges.append([start, end])
+    except ValueError:
+        return None
+    # 合并重叠和相邻的范围，避免客户端请求大量重复数据
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(r) for r in merged]
 
 
 # 路由方法
+def _route_pattern(route):
+    """
+    把路由字符串中的占位符替换为命名组，返回正则表达式源码
+    """
+    route = re.sub(r':([a-zA-Z_]+)(?P<uniq>[^\w/])(?P<re>.+?)(?P=uniq)', r'(?P<\1>\g<re>)', route)
+    return re.sub(r':([a-zA-Z_]+)', r'(?P<\1>[^/]+)', route)
+
+
 def compile_route(route):
     """
     编译路由字符串，返回预编译正则表达式对象
@@ -362,9 +1446,103 @@ def compile_route(route):
         除了使用'#'以外，你可以使用任何单独的特殊字符除了'/'
     """
     route = route.strip().lstrip('$^/ ').rstrip('$^ ')
-    route = re.sub(r':([a-zA-Z_]+)(?P<uniq>[^\w/])(?P<re>.+?)(?P=uniq)', r'(?P<\1>\g<re>)', route)
-    route = re.sub(r':([a-zA-Z_]+)', r'(?P<\1>[^/]+)', route)
-    return re.compile('^/%s$' % route)
+    return re.compile('^/%s$' % _route_pattern(route))
+
+
+class RouteNode(object):
+    """
+    路由前缀树节点
+
+    静态分段通过字典直接查找，只有占位符分段才会尝试正则匹配，
+    可能跨越 '/' 的路由剩余部分作为整体正则挂在节点上
+    first 记录子树中最早添加的路由序号，用于保持 add_route 的先到先得语义
+    """
+    __slots__ = ('static', 'dynamic', 'tails', 'target', 'first')
+
+    def __init__(self):
+        self.static = {}
+        self.dynamic = {}
+        self.tails = []
+        self.target = None
+        self.first = sys.maxsize
+
+
+# 不包含正则元字符的分段按字面量处理
+ROUTE_STATIC_SEGMENT = re.compile(r'^[^.^$*+?{}\[\]\\|()]*$')
+# 只由字面量、命名组、[^/] 以及不能匹配 '/' 的字符集组成的分段
+ROUTE_SAFE_SEGMENT = re.compile(r'^(?:[\w\-~%&\',;@ ]|\(\?P<\w+>|\[\^/\]|\\[dw]|\[(?:\w|\\[dw]|-)+\]|[+*?{},()])*$')
+
+
+def _route_segments(route):
+    """
+    把路由拆分为分段正则源码列表
+
+    返回 (分段列表, 是否完整)，不完整时剩余部分需要用整条路由正则匹配
+    """
+    route = route.strip().lstrip('$^/ ').rstrip('$^ ')
+    parts = route.split('/')
+    patterns = [_route_pattern(part) for part in parts]
+    # 分段替换的结果必须与整条路由一致，否则说明占位符中的正则跨越了 '/'
+    consistent = '/'.join(patterns) == _route_pattern(route)
+    segments = []
+    for part, pattern in zip(parts, patterns):
+        if ROUTE_STATIC_SEGMENT.match(part) and ':' not in part:
+            segments.append((True, part))
+        elif consistent and ROUTE_SAFE_SEGMENT.match(pattern):
+            segments.append((False, pattern))
+        else:
+            return segments, False
+    return segments, True
+
+
+def _insert_route(root, route, index, regex, handler):
+    """
+    把一条路由插入前缀树
+    """
+    segments, complete = _route_segments(route)
+    node = root
+    node.first = min(node.first, index)
+    for static, pattern in segments:
+        if static:
+            node = node.static.setdefault(pattern, RouteNode())
+        else:
+            if pattern not in node.dynamic:
+                node.dynamic[pattern] = (re.compile('^%s$' % pattern), RouteNode())
+            node = node.dynamic[pattern][1]
+        node.first = min(node.first, index)
+    if not complete:
+        node.tails.append((index, regex, handler))
+    elif node.target is None:
+        node.target = (index, handler)
+
+
+def _search_route(node, url, parts, depth, args, best):
+    """
+    深度优先搜索前缀树，best 保存目前序号最小的匹配 [序号, handler, 参数]
+    子树中最早的路由都晚于当前结果时直接剪枝
+    """
+    if node.first >= best[0]:
+        return
+    if depth == len(parts):
+        if node.target and node.target[0] < best[0]:
+            best[:] = [node.target[0], node.target[1], args]
+    else:
+        part = parts[depth]
+        child = node.static.get(part)
+        if child is not None:
+            _search_route(child, url, parts, depth + 1, args, best)
+        for regex, child in node.dynamic.values():
+            if child.first < best[0]:
+                match = regex.match(part)
+                if match:
+                    _search_route(child, url, parts, depth + 1, dict(args, **match.groupdict()), best)
+    for index, regex, handler in node.tails:
+        if index >= best[0]:
+            break
+        match = regex.match(url)
+        if match:
+            best[:] = [index, handler, match.groupdict()]
+            break
 
 
 def match_url(url, method='GET'):
@@ -372,27 +1550,40 @@ def match_url(url, method='GET'):
     返回第一个匹配的 Handler 和一个参数字典
     否则抛出 HTTPError(404) 异常
 
-    每隔 1000 个请求重新排列一次 ROUTING_REGEXP 列表
-    如果要关闭此功能，使用 OPTIMIZER = False
+    正则路由保存在按分段组织的前缀树中，查找代价取决于路径深度而不是路由数量
+    多条路由都能匹配时，仍然返回最早添加的那一条
+    启用 ROUTE_CACHE 后，正则路由的匹配结果按 (method, url) 缓存
+    """
+    handler, args, route = match_route(url, method)
+    return handler, args
+
+
+def match_route(url, method='GET'):
+    """
+    与 match_url 相同，同时返回匹配的路由字符串 (handler, args, route)
     """
     url = '/' + url.strip().lstrip("/")
 
     # 优先在静态路由表中查找
-    route = ROUTES_SIMPLE.get(method, {}).get(url, None)
-    if route:
-        return route, {}
-
-    # 搜索正则表达式路由配置
-    routes = ROUTES_REGEXP.get(method, [])
-    for i in range(len(routes)):
-        match = routes[i][0].match(url)
-        if match:
-            handler = routes[i][1]
-            if i > 0 and OPTIMIZER and random.random() <= 0.001:
-                # 每 1000 次请求，将路由匹配列表中的元素与其前驱进行交换
-                # 经常使用的线路会逐渐出现在列表前面
-                routes[i - 1], routes[i] = routes[i], routes[i - 1]
-            return handler, match.groupdict()
+    handler = ROUTES_SIMPLE.get(method, {}).get(url, None)
+    if handler:
+        return handler, {}, url
+
+    # 查找热点 url 的缓存结果
+    if ROUTE_CACHE.maxsize > 0:
+        cached = ROUTE_CACHE.get((method, url))
+        if cached is not None:
+            return cached[0], dict(cached[1]), cached[2]
+
+    # 搜索正则表达式路由前缀树
+    root = ROUTES_TREE.get(method, None)
+    if root is not None:
+        best = [sys.maxsize, None, None]
+        _search_route(root, url, url[1:].split('/'), 0, {}, best)
+        if best[1] is not None:
+            route = ROUTES_REGEXP[method][best[0]][2]
+            ROUTE_CACHE.put((method, url), (best[1], best[2], route))
+            return best[1], dict(best[2]), route
     raise HTTPError(404, "Not Found")
 
 
@@ -409,8 +1600,12 @@ def add_route(route, handler, method='GET', simple=False):
     if re.match(r'^/(\w+/)*\w*$', route) or simple:
         ROUTES_SIMPLE.setdefault(method, {})[route] = handler
     else:
-        route = compile_route(route)
-        ROUTES_REGEXP.setdefault(method, []).append([route, handler])
+        regex = compile_route(route)
+        routes = ROUTES_REGEXP.setdefault(method, [])
+        _insert_route(ROUTES_TREE.setdefault(method, RouteNode()), route, len(routes), regex, handler)
+        routes.append([regex, handler, route])
+    # 路由表发生变化，缓存的匹配结果可能已经失效
+    ROUTE_CACHE.clear()
 
 
 def route(url, **kargs):
@@ -466,10 +1661,289 @@ def error(code=500):
     return wrapper
 
 
-# 服务器适配器
-class ServerAdapter(object):
+# 请求指标
+class RouteMetrics(object):
+    """
+    按路由模式统计的请求指标：各状态码类别的请求数、固定分桶的延迟直方图、
+    正在处理的请求数和响应字节数。按路由模式而不是原始路径记录，指标数量有上限
+
+    数据保存在匿名共享内存中，每个进程写入自己的 slot，
+    PreforkServer 在 fork 之前调用 share()，任何一个工作进程都能输出所有进程的汇总结果
+    多进程时序号在 fork 之前按已经注册的路由分配，因此路由需要在启动服务器之前添加
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    # 每个序列的字段：1xx-5xx 请求数、正在处理的请求数、响应字节数、延迟总和、各个分桶（最后一个为 +Inf）
+    IN_FLIGHT, BYTES, SUM, BUCKETS = 5, 6, 7, 8
+    UNMATCHED, OTHER = ('*', '<unmatched>'), ('*', '<other>')
+
+    def __init__(self, max_series=1024):
+        self.max_series = max_series
+        self.width = self.BUCKETS + len(self.buckets) + 1
+        self.lock = threading.Lock()
+        self.series = {}
+        self.share(1)
+
+    def share(self, slots):
+        """
+        为 slots 个进程分配共享内存，已经记录的数据会被清空
+        """
+        self.slots = slots
+        self.slot = 0
+        self.memory = mmap.mmap(-1, slots * self.max_series * self.width * 8)
+        self.data = memoryview(self.memory).cast('d')
+        self.series.clear()
+        for key in (self.UNMATCHED, self.OTHER):
+            self.index(*key)
+        for method, routes in ROUTES_SIMPLE.items():
+            for route in routes:
+                self.index(method, route)
+        for method, routes in ROUTES_REGEXP.items():
+            for route in routes:
+                self.index(method, route[2])
+
+    def index(self, method, route):
+        """
+        返回 (method, route) 的序列序号，超过 max_series 时归入 <other>
+        """
+        key = (method, route)
+        index = self.series.get(key)
+        if index is None:
+            with self.lock:
+                index = self.series.get(key)
+                if index is None:
+                    index = len(self.series) if len(self.series) < self.max_series else self.series[self.OTHER]
+                    self.series[key] = index
+        return index
+
+    def reset_slot(self, slot):
+        """
+        进程异常退出后清零它遗留的正在处理的请求数，计数器保持累加
+        """
+        for index in set(self.series.values()):
+            self.data[(slot * self.max_series + index) * self.width + self.IN_FLIGHT] = 0
+
+    def begin(self, method, route):
+        """
+        开始处理一个请求，返回 observe() 使用的序列序号
+        """
+        index = self.index(method, route)
+        offset = (self.slot * self.max_series + index) * self.width
+        with self.lock:
+            self.data[offset + self.IN_FLIGHT] += 1
+        return index
+
+    def observe(self, index, started, output):
+        """
+        请求处理完毕，长度未知的迭代器输出被包装，在服务器调用 close() 时记录
+        index 为 None 表示没有匹配的路由
+        """
+        response = RESPONSE_CONTEXT.get()
+        status = response.status
+        if index is None:
+            index = self.begin(*self.UNMATCHED)
+        if isinstance(output, list):
+            self.record(index, status, started, sum(map(len, output)))
+            return output
+        if hasattr(output, 'read'):
+            self.record(index, status, started, int(response.header.get('Content-Length') or 0))
+            return output
+        return MetricsOutput(self, index, status, started, output)
+
+    def record(self, index, status, started, size):
+        elapsed = time.perf_counter() - started
+        offset = (self.slot * self.max_series + index) * self.width
+        data = self.data
+        with self.lock:
+            data[offset + min(max(status // 100, 1), 5) - 1] += 1
+            data[offset + self.IN_FLIGHT] -= 1
+            data[offset + self.BYTES] += size
+            data[offset + self.SUM] += elapsed
+            data[offset + self.BUCKETS + bisect.bisect_left(self.buckets, elapsed)] += 1
+
+    def totals(self, index):
+        """
+        返回所有进程中一个序列的各字段之和
+        """
+        values = [0.0] * self.width
+        for slot in range(self.slots):
+            offset = (slot * self.max_series + index) * self.width
+            for i, value in enumerate(self.data[offset:offset + self.width]):
+                values[i] += value
+        return values
+
+    def exposition(self):
+        """
+        以 Prometheus 文本格式输出所有进程汇总后的指标
+        """
+        requests = ['# HELP bottle_requests_total Requests handled, by route and status class.',
+                    '# TYPE bottle_requests_total counter']
+        in_flight = ['# HELP bottle_requests_in_flight Requests currently being handled.',
+                     '# TYPE bottle_requests_in_flight gauge']
+        sizes = ['# HELP bottle_response_bytes_total Response body bytes sent.',
+                 '# TYPE bottle_response_bytes_total counter']
+        latency = ['# HELP bottle_request_duration_seconds Request handling time.',
+                   '# TYPE bottle_request_duration_seconds histogram']
+        seen = set()
+        for (method, route), index in sorted(self.series.items(), key=lambda item: item[1]):
+            if index in seen:
+                continue
+            seen.add(index)
+            values = self.totals(index)
+            count = sum(values[:5])
+            if not count and not values[self.IN_FLIGHT]:
+                continue
+            labels = 'method="%s",route="%s"' % (_label(method), _label(route))
+            for i in range(5):
+                if values[i]:
+                    requests.append('bottle_requests_total{%s,status="%dxx"} %d' % (labels, i + 1, values[i]))
+            in_flight.append('bottle_requests_in_flight{%s} %d' % (labels, values[self.IN_FLIGHT]))
+            sizes.append('bottle_response_bytes_total{%s} %d' % (labels, values[self.BYTES]))
+            cumulative = 0
+            for bound, value in zip(self.buckets + ('+Inf',), values[self.BUCKETS:]):
+                cumulative += value
+                latency.append('bottle_request_duration_seconds_bucket{%s,le="%s"} %d' % (labels, bound, cumulative))
+            latency.append('bottle_request_duration_seconds_sum{%s} %r' % (labels, values[self.SUM]))
+            latency.append('bottle_request_duration_seconds_count{%s} %d' % (labels, count))
+        return '\n'.join(requests + in_flight + sizes + latency) + '\n'
+
+
+class MetricsOutput(object):
+    """
+    统计迭代器输出的字节数，服务器调用 close() 时记录请求指标
+    """
+
+    def __init__(self, metrics, index, status, started, output):
+        self.metrics = metrics
+        self.index = index
+        self.status = status
+        self.started = started
+        self.output = output
+        self.size = 0
+        self.recorded = False
+
+    def __iter__(self):
+        for chunk in self.output:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        if not self.recorded:
+            self.recorded = True
+            self.metrics.record(self.index, self.status, self.started, self.size)
+        if hasattr(self.output, 'close'):
+            self.output.close()
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def enable_metrics(endpoint='/metrics', max_series=1024):
+    """
+    开始记录请求指标，endpoint 不为 None 时添加一个输出 Prometheus 文本格式的路由
+    """
+    global METRICS
+    METRICS = RouteMetrics(max_series)
+    if endpoint:
+        add_route(endpoint, metrics_handler)
+    return METRICS
+
+
+def metrics_handler():
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return METRICS.exposition()
+
+
+# 请求计时
+class PhaseTimer(object):
+    """
+    把 with 语句块的耗时累加到 timings[name]
+    """
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings[self.name] = self.timings.get(self.name, 0.0) + time.perf_counter() - self.start
+
+
+class TimedOutput(object):
+    """
+    记录服务器迭代输出时在产生数据上花费的时间，在 close() 时写入慢请求日志
+    """
+
+    def __init__(self, output, entry, timings, started, stream):
+        self.output = output
+        self.entry = entry
+        self.timings = timings
+        self.started = started
+        self.stream = stream
+        self.logged = False
+
+    def __iter__(self):
+        iterator = iter(self.output)
+        with PhaseTimer(self.timings, 'output'):
+            chunk = next(iterator, None)
+        while chunk is not None:
+            yield chunk
+            with PhaseTimer(self.timings, 'output'):
+                chunk = next(iterator, None)
+
+    def close(self):
+        if not self.logged:
+            self.logged = True
+            log_slow_request(self.stream, self.entry, self.timings, time.perf_counter() - self.started)
+        if hasattr(self.output, 'close'):
+            self.output.close()
+
+
+def finish_timing(timings, started, route, output):
+    """
+    添加 Server-Timing 标头，处理时间超过 SLOW_REQUEST_THRESHOLD 时写入慢请求日志
+    迭代器输出要等服务器迭代完毕才知道输出阶段的耗时，因此在 close() 时再写日志
+    """
+    request, response = REQUEST_CONTEXT.get(), RESPONSE_CONTEXT.get()
+    elapsed = time.perf_counter() - started
+    if SERVER_TIMING:
+        phases = ['%s;dur=%.3f' % (name, value * 1000) for name, value in timings.items()]
+        response.header['Server-Timing'] = ', '.join(phases + ['total;dur=%.3f' % (elapsed * 1000)])
+    if SLOW_REQUEST_THRESHOLD is None:
+        return output
+    entry = {'method': request.method, 'path': request.path, 'query': request.query_string,
+             'route': route, 'status': response.status}
+    stream = SLOW_REQUEST_LOG or request._environ.get('wsgi.errors', sys.stderr)
+    if isinstance(output, list) or hasattr(output, 'read'):
+        log_slow_request(stream, entry, timings, elapsed)
+        return output
+    return TimedOutput(output, entry, timings, started, stream)
+
+
+def log_slow_request(stream, entry, timings, elapsed):
+    """
+    总耗时超过 SLOW_REQUEST_THRESHOLD 秒时，以一行 JSON 写入请求信息和各阶段耗时（毫秒）
+    """
+    if elapsed < SLOW_REQUEST_THRESHOLD:
+        return
+    entry = dict(entry, time=email.utils.formatdate(usegmt=True), total_ms=round(elapsed * 1000, 3),
+                 phases={name: round(value * 1000, 3) for name, value in timings.items()})
+    stream.write(JSON_ENCODER.encode(entry) + '\n')
+    stream.flush()
+
+
+# 服务器适配器
+class ServerAdapter(object):
     """
     服务器适配器，用于为多个不同的服务器端，提供统一的接口
+    host 除了主机名以外还可以是：
+        unix:/path/to/app.sock  监听 unix 套接字，可选参数 unix_mode 为套接字文件的权限（例如 0o660）
+        fd:3                    使用继承的已经在监听的文件描述符，例如平滑重启时由旧进程传入
+        systemd                 使用 systemd 套接字激活传入的第一个文件描述符（LISTEN_FDS）
     """
 
     def __init__(self, host='127.0.0.1', port=8080, **kargs):
@@ -477,41 +1951,697 @@ class ServerAdapter(object):
         self.port = int(port)
         self.options = kargs
 
+    # 为 True 时 run() 传入 ASGIHandler，否则传入 WSGIHandler
+    asgi = False
+
     def __repr__(self):
-        return "%s (%s:%d)" % (self.__class__.__name__, self.host, self.port)
+        if self.tcp:
+            return "%s (%s:%d)" % (self.__class__.__name__, self.host, self.port)
+        return "%s (%s)" % (self.__class__.__name__, self.host)
+
+    @property
+    def tcp(self):
+        """
+        是否由服务器自己监听 host:port
+        """
+        return not (self.host.startswith(('unix:', 'fd:')) or self.host == 'systemd')
+
+    @property
+    def address(self):
+        """
+        监听地址，unix 套接字为文件路径，其他为 (host, port)
+        """
+        return self.host[5:] if self.host.startswith('unix:') else (self.host, self.port)
+
+    def listen_socket(self, backlog=128):
+        """
+        创建 unix 套接字或者取得继承的套接字，并开始监听
+        监听 host:port 时返回 None，由服务器自己创建套接字
+        """
+        if self.tcp:
+            return None
+        if self.host.startswith('unix:'):
+            path = self.address
+            try:
+                # 删除上次运行留下的套接字文件
+                if S_ISSOCK(os.stat(path).st_mode):
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            mode = self.options.get('unix_mode')
+            if mode is None:
+                sock.bind(path)
+            else:
+                # 先以只有自己可以访问的权限创建套接字文件，chmod 之前其他用户不能连接
+                umask = os.umask(0o177)
+                try:
+                    sock.bind(path)
+                finally:
+                    os.umask(umask)
+                os.chmod(path, int(mode, 8) if isinstance(mode, str) else mode)
+        else:
+            sock = socket.socket(fileno=listen_fd(self.host))
+        sock.listen(backlog)
+        return sock
 
     def run(self, handler):
         pass
 
 
+def listen_fd(host):
+    """
+    解析 fd:N 或 systemd，返回要使用的已经在监听的文件描述符
+    """
+    if host != 'systemd':
+        return int(host[3:])
+    if os.environ.get('LISTEN_PID') != str(os.getpid()) or int(os.environ.get('LISTEN_FDS', 0)) < 1:
+        raise RuntimeError('No socket passed by systemd (LISTEN_FDS is not set for this process).')
+    # 与 sd_listen_fds(1) 相同，避免子进程误用这些环境变量
+    for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+        os.environ.pop(name, None)
+    return 3
+
+
 class WSGIRefServer(ServerAdapter):
     def run(self, handler):
-        from wsgiref.simple_server import make_server
-        srv = make_server(self.host, self.port, handler)
+        srv = self.make_server(handler)
         srv.serve_forever()
 
+    def make_server(self, handler, server_class=None, timeout=None, max_requests=1, idle_timeout=None):
+        """
+        创建 wsgiref 服务器，文件响应通过 os.sendfile 发送
+        timeout 为连接上读取请求的超时秒数
+        max_requests 为每个连接最多处理的请求数，大于 1 时使用 HTTP/1.1 持久连接，
+        idle_timeout 为持久连接上等待下一个请求的秒数
+        可选参数 access_log 为 False 时不向 stderr 输出每个请求的访问日志
+        """
+        from wsgiref.simple_server import make_server, ServerHandler, WSGIRequestHandler, WSGIServer
+
+        class SendfileServerHandler(ServerHandler):
+            keep_alive = False
+            chunked = False
+
+            def cleanup_headers(self):
+                ServerHandler.cleanup_headers(self)
+                if self.request_handler.protocol_version != 'HTTP/1.1':
+                    return
+                bodyless = self.environ['REQUEST_METHOD'] == 'HEAD' or self.bodyless_status()
+                if self.keep_alive and 'Content-Length' not in self.headers and not bodyless:
+                    # 不知道响应体长度时使用分块编码，HTTP/1.0 客户端只能关闭连接
+                    if self.request_handler.request_version == 'HTTP/1.1':
+                        self.chunked = True
+                        self.headers['Transfer-Encoding'] = 'chunked'
+                    else:
+                        self.keep_alive = False
+                self.headers['Connection'] = 'keep-alive' if self.keep_alive else 'close'
+
+            def write(self, data):
+                if self.environ['REQUEST_METHOD'] == 'HEAD':
+                    # HEAD 请求只发送响应头，否则持久连接上的下一个响应会错位
+                    if not self.headers_sent:
+                        self.bytes_sent = len(data)
+                        self.send_headers()
+                    return
+                if not self.headers_sent:
+                    # 发送响应头时才会决定是否使用分块编码
+                    self.bytes_sent = len(data)
+                    self.send_headers()
+                if self.chunked and data:
+                    data = b'%x\r\n%s\r\n' % (len(data), data)
+                ServerHandler.write(self, data)
+
+            def bodyless_status(self):
+                status = int(self.status[:3])
+                return status in (204, 304) or status < 200
+
+            def set_content_length(self):
+                # 204、304 和 1xx 响应不能带有 wsgiref 补上的 Content-Length（RFC 9110 §8.6）
+                if not self.bodyless_status():
+                    ServerHandler.set_content_length(self)
+
+            def finish_content(self):
+                if not self.headers_sent and self.bodyless_status():
+                    self.send_headers()
+                ServerHandler.finish_content(self)
+                if self.chunked:
+                    self._write(b'0\r\n\r\n')
+                # HEAD 和空响应只有响应头，同样需要立即发送
+                self._flush()
+
+            def handle_error(self):
+                self.keep_alive = False
+                ServerHandler.handle_error(self)
+
+            def sendfile(self):
+                """
+                文件响应通过 os.sendfile 发送，不再经过 Python 复制数据
+                HEAD 请求只发送响应头，不读取文件
+                """
+                if self.chunked:
+                    return False
+                if not self.headers_sent:
+                    self.send_headers()
+                self._flush()
+                if self.environ['REQUEST_METHOD'] == 'HEAD':
+                    return True
+                length = self.headers.get('Content-Length')
+                sent = sendfile(self.request_handler.connection, self.result.filelike,
+                                int(length) if length else None)
+                if sent is None:
+                    return False
+                self.bytes_sent += sent
+                return True
+
+        class SendfileRequestHandler(WSGIRequestHandler):
+            protocol_version = 'HTTP/1.1' if max_requests > 1 else 'HTTP/1.0'
+
+            # 缓冲响应头，与第一块响应体一起发送
+            wbufsize = 65536
+
+            def setup(self):
+                if not isinstance(self.client_address, tuple):
+                    # unix 套接字没有客户端地址
+                    self.client_address = ('', 0)
+                else:
+                    # 持久连接上分多次写出的小数据块不能等待对方的延迟确认
+                    self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                WSGIRequestHandler.setup(self)
+
+            def handle(self):
+                for served in range(max_requests):
+                    if not self.handle_one_request(idle_timeout if served else None, served + 1 < max_requests):
+                        return
+
+            def handle_one_request(self, idle_timeout=None, keep_alive=False):
+                """
+                处理连接上的一个请求，返回 True 时可以继续读取下一个请求
+                keep_alive 为 False 时这是连接上的最后一个请求
+                管道化的请求已经在 rfile 的缓冲区中，按顺序依次处理
+                """
+                try:
+                    if idle_timeout is not None:
+                        self.connection.settimeout(idle_timeout)
+                        self.raw_requestline = self.rfile.readline(65537)
+                        self.connection.settimeout(self.timeout)
+                    else:
+                        self.raw_requestline = self.rfile.readline(65537)
+                except OSError:
+                    # 读取超时或者连接被重置
+                    return False
+                if not self.raw_requestline:
+                    return False
+                if len(self.raw_requestline) > 65536:
+                    self.requestline = ''
+                    self.request_version = ''
+                    self.command = ''
+                    self.send_error(414)
+                    return False
+                try:
+                    if not self.parse_request():
+                        return False
+                except OSError:
+                    # 读取请求头时超时，与读取请求行时一样直接关闭连接
+                    return False
+                try:
+                    body = RequestBody(self.rfile, int(self.headers.get('Content-Length') or 0),
+                                       'chunked' in self.headers.get('Transfer-Encoding', '').lower())
+                except ValueError:
+                    self.send_error(400, 'Invalid Content-Length')
+                    return False
+                environ = self.get_environ()
+                environ['wsgi.input_terminated'] = True
+                server_handler = SendfileServerHandler(body, self.wfile, self.get_stderr(), environ,
+                                                       multithread=getattr(self.server, 'multithread', False))
+                server_handler.request_handler = self
+                server_handler.keep_alive = keep_alive and not self.close_connection
+                server_handler.http_version = self.request_version[5:] if max_requests > 1 else '1.0'
+                server_handler.run(self.server.get_app())
+                # 丢弃处理器没有读取的请求体，才能读取同一连接上的下一个请求
+                return server_handler.keep_alive and body.drain()
+
+        SendfileRequestHandler.timeout = timeout
+        if not self.options.get('access_log', True):
+            SendfileRequestHandler.log_request = lambda self, code='-', size='-': None
+        server_class = server_class or WSGIServer
+        sock = self.listen_socket(server_class.request_queue_size)
+        if sock is None:
+            return make_server(self.host, self.port, handler, server_class=server_class,
+                               handler_class=SendfileRequestHandler)
+        srv = server_class(('', 0), SendfileRequestHandler, bind_and_activate=False)
+        srv.socket.close()
+        srv.socket = sock
+        name = sock.getsockname()
+        srv.server_name, srv.server_port = name[:2] if isinstance(name, tuple) else ('localhost', self.port)
+        srv.setup_environ()
+        srv.set_app(handler)
+        return srv
+
+
+class RequestBody(object):
+    """
+    同步服务器使用的 wsgi.input，只能读到当前请求体的结尾，同时解码 chunked 编码
+    处理器即使调用不带参数的 read() 也不会阻塞在持久连接上
+    """
+
+    def __init__(self, stream, length, chunked=False):
+        self.chunks = iter_chunked(stream) if chunked else iter_input(stream, length)
+        self.buffer = b''
+
+    def fill(self, size, sep=None):
+        while size < 0 or len(self.buffer) < size:
+            if sep is not None and sep in self.buffer:
+                break
+            chunk = next(self.chunks, b'')
+            if not chunk:
+                break
+            self.buffer += chunk
+
+    def read(self, size=-1):
+        size = -1 if size is None else size
+        self.fill(size)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        size = -1 if size is None else size
+        self.fill(size, b'\n')
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        if size >= 0:
+            end = min(end, size)
+        data, self.buffer = self.buffer[:end], self.buffer[end:]
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def drain(self):
+        """
+        读取并丢弃剩余的请求体，请求体不完整或格式错误时返回 False
+        """
+        self.buffer = b''
+        try:
+            for chunk in self.chunks:
+                pass
+        except (HTTPError, OSError):
+            return False
+        return True
+
+
+class ThreadedServer(WSGIRefServer):
+    """
+    只依赖标准库的线程池服务器
+    主线程只负责接受连接，请求放入有界队列后由固定数量的工作线程处理，
+    队列已满时立即返回 503，一个慢请求不会阻塞其他请求
+
+    可选参数：
+        threads     工作线程数量，默认 16
+        backlog     监听套接字的等待连接队列长度，默认 128
+        queue_size  等待工作线程处理的最大连接数，默认 threads * 4
+        timeout     连接上读取请求的超时秒数，默认 30
+    """
+
+    def run(self, handler):
+        from wsgiref.simple_server import WSGIServer
+        threads = int(self.options.get('threads', 16))
+        backlog = int(self.options.get('backlog', 128))
+        requests = queue.SimpleQueue()
+        # 正在处理和排队等待的连接总数不超过 threads + queue_size
+        slots = threading.BoundedSemaphore(threads + int(self.options.get('queue_size', threads * 4)))
+
+        class PoolServer(WSGIServer):
+            request_queue_size = backlog
+            multithread = True
+
+            def process_request(self, request, client_address):
+                if slots.acquire(blocking=False):
+                    requests.put((request, client_address))
+                else:
+                    try:
+                        request.sendall(b'HTTP/1.0 503 SERVICE UNAVAILABLE\r\n'
+                                        b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+                    except OSError:
+                        pass
+                    self.shutdown_request(request)
+
+        srv = self.make_server(handler, PoolServer, float(self.options.get('timeout', 30)))
+
+        def worker():
+            while True:
+                item = requests.get()
+                if item is None:
+                    break
+                request, client_address = item
+                try:
+                    srv.finish_request(request, client_address)
+                except Exception:
+                    srv.handle_error(request, client_address)
+                finally:
+                    srv.shutdown_request(request)
+                    slots.release()
+
+        workers = [threading.Thread(target=worker, name='bottle-worker-%d' % i, daemon=True)
+                   for i in range(threads)]
+        for thread in workers:
+            thread.start()
+        try:
+            srv.serve_forever()
+        finally:
+            for thread in workers:
+                requests.put(None)
+            srv.server_close()
+
+
+class PreforkServer(WSGIRefServer):
+    """
+    多进程服务器，仅支持 Unix
+    主进程监听一次端口后 fork 出多个工作进程，每个进程各自运行 WSGIHandler，
+    从而可以利用多个 CPU 核心。主进程只负责监控，工作进程异常退出后会被重新创建
+
+    可选参数：
+        workers           工作进程数量，默认为 CPU 核心数
+        max_requests      每个工作进程处理多少个请求后退出并被替换，0 为不限制，默认 0
+        reuse_port        为 True 时每个工作进程使用 SO_REUSEPORT 各自监听，由内核分配连接
+        graceful_timeout  收到 SIGTERM 后等待工作进程处理完当前请求的秒数，默认 30
+        timeout           连接上读取请求的超时秒数，默认 30
+
+    收到 SIGTERM 或 SIGINT 时主进程通知所有工作进程停止接受新连接，
+    超过 graceful_timeout 仍未退出的工作进程会被强制结束
+    """
+
+    def run(self, handler):
+        from wsgiref.simple_server import WSGIServer
+        self.handler = handler
+        self.max_requests = int(self.options.get('max_requests', 0))
+        self.timeout = float(self.options.get('timeout', 30))
+
+        class PreforkWSGIServer(WSGIServer):
+            allow_reuse_port = bool(self.options.get('reuse_port', False)) and self.tcp
+            requests = 0
+
+            def process_request(self, request, client_address):
+                self.requests += 1
+                WSGIServer.process_request(self, request, client_address)
+
+        self.server_class = PreforkWSGIServer
+        # 不使用 SO_REUSEPORT 时在主进程中监听，所有工作进程共享同一个套接字
+        self.server = None if self.server_class.allow_reuse_port else self.make_server(
+            handler, self.server_class, self.timeout)
+        self.workers = {}
+        self.stopping = False
+        workers = int(self.options.get('workers', 0)) or os.cpu_count() or 1
+        if METRICS is not None:
+            # 工作进程把请求指标写入共享内存中各自的 slot
+            METRICS.share(workers)
+        graceful_timeout = int(self.options.get('graceful_timeout', 30))
+
+        def stop(signum, frame):
+            if not self.stopping:
+                self.stopping = True
+                self.kill_workers(signal.SIGTERM)
+                signal.alarm(max(graceful_timeout, 1))
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGALRM, lambda signum, frame: self.kill_workers(signal.SIGKILL))
+        try:
+            for slot in range(workers):
+                self.spawn_worker(slot)
+            while self.workers:
+                try:
+                    pid, status = os.wait()
+                except KeyboardInterrupt:
+                    stop(signal.SIGINT, None)
+                    continue
+                except ChildProcessError:
+                    break
+                started, slot = self.workers.pop(pid, (None, None))
+                if started is None or self.stopping:
+                    continue
+                if time.time() - started < 1:
+                    # 避免启动即崩溃的工作进程被无限快速地重新创建
+                    time.sleep(1)
+                # 等待期间可能已经收到 SIGTERM，这时不能再创建收不到停止信号的工作进程
+                if not self.stopping:
+                    if METRICS is not None:
+                        METRICS.reset_slot(slot)
+                    self.spawn_worker(slot)
+        finally:
+            signal.alarm(0)
+            self.kill_workers(signal.SIGKILL)
+            if self.server is not None:
+                self.server.server_close()
+
+    def kill_workers(self, signum):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                self.workers.pop(pid, None)
+
+    def spawn_worker(self, slot=0):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = (time.time(), slot)
+            return pid
+        if METRICS is not None:
+            METRICS.slot = slot
+        status = 0
+        try:
+            self.serve_worker()
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def serve_worker(self):
+        """
+        工作进程的主循环，收到 SIGTERM 后处理完当前请求再退出
+        """
+        stopping = []
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: stopping.append(signum))
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        srv = self.server or self.make_server(self.handler, self.server_class, self.timeout)
+        # 多个进程等待同一个套接字时，没有抢到连接的进程不能阻塞在 accept() 上
+        srv.socket.setblocking(False)
+        srv.timeout = 1.0
+        while not stopping and not (self.max_requests and srv.requests >= self.max_requests):
+            srv.handle_request()
+        srv.server_close()
+
+
+class HTTP11Server(ThreadedServer):
+    """
+    支持 HTTP/1.1 持久连接和管道化请求的线程池服务器
+    响应没有 Content-Length 时使用分块编码，同一连接上的请求按顺序处理
+    空闲的持久连接会占用一个工作线程，threads 需要大于同时保持的连接数
+
+    可选参数（另见 ThreadedServer）：
+        keepalive_timeout       持久连接上等待下一个请求的秒数，默认 5
+        max_keepalive_requests  每个连接最多处理的请求数，默认 100
+    """
+
+    def make_server(self, handler, server_class=None, timeout=None, max_requests=None, idle_timeout=None):
+        return WSGIRefServer.make_server(
+            self, handler, server_class, timeout,
+            max_requests or int(self.options.get('max_keepalive_requests', 100)),
+            idle_timeout or float(self.options.get('keepalive_timeout', 5)))
+
 
 class CherryPyServer(ServerAdapter):
     def run(self, handler):
         from cherrypy import wsgiserver
-        server = wsgiserver.CherryPyWSGIServer((self.host, self.port), handler)
+        server = wsgiserver.CherryPyWSGIServer(self.address, handler)
         server.start()
 
 
 class FlupServer(ServerAdapter):
     def run(self, handler):
         from flup.server.fcgi import WSGIServer
-        WSGIServer(handler, bindAddress=(self.host, self.port)).run()
+        WSGIServer(handler, bindAddress=self.address).run()
 
 
 class PasteServer(ServerAdapter):
     def run(self, handler):
+        if not self.tcp:
+            raise RuntimeError('PasteServer only supports host:port binds.')
         from paste import httpserver
         from paste.translogger import TransLogger
         app = TransLogger(handler)
         httpserver.serve(app, host=self.host, port=str(self.port))
 
 
+class AsyncioServer(ServerAdapter):
+    """
+    基于 asyncio 的 HTTP/1.1 服务器，以 ASGI 协议调用 ASGIHandler
+    一个进程可以同时保持大量慢连接，async def 处理器中的 await 不会阻塞其他请求
+    可选参数：timeout 空闲连接超时秒数（默认 30），backlog（默认 1024）
+    """
+    asgi = True
+
+    def run(self, handler):
+        asyncio.run(self.serve(handler))
+
+    async def serve(self, handler):
+        backlog = int(self.options.get('backlog', 1024))
+        sock = self.listen_socket(backlog)
+        if sock is None:
+            server = await asyncio.start_server(
+                lambda reader, writer: self.handle(handler, reader, writer),
+                self.host, self.port, backlog=backlog)
+        else:
+            server = await asyncio.start_server(
+                lambda reader, writer: self.handle(handler, reader, writer), sock=sock, backlog=backlog)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, handler, reader, writer):
+        timeout = float(self.options.get('timeout', 30))
+        # unix 套接字的地址是文件路径（或空字符串），不放入 scope
+        peer, sockname = writer.get_extra_info('peername'), writer.get_extra_info('sockname')
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), timeout)
+                    while line in (b'\r\n', b'\n'):
+                        line = await asyncio.wait_for(reader.readline(), timeout)
+                    if not line:
+                        break
+                    method, target, version = line.decode('latin1').split()
+                    headers = []
+                    while True:
+                        header = await asyncio.wait_for(reader.readline(), timeout)
+                        if header in (b'\r\n', b'\n', b''):
+                            break
+                        if len(headers) >= 100:
+                            raise ValueError('Too many headers')
+                        name, _, value = header.decode('latin1').partition(':')
+                        headers.append((name.strip().lower().encode('latin1'), value.strip().encode('latin1')))
+                    header_map = dict(headers)
+                    body = AsyncBodyReader(reader, header_map)
+                except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+                    break
+                except ValueError:
+                    writer.write(b'HTTP/1.1 400 BAD REQUEST\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                    break
+
+                connection = header_map.get(b'connection', b'').lower()
+                keep_alive = (version == 'HTTP/1.1' and connection != b'close') or connection == b'keep-alive'
+                path, _, query = target.partition('?')
+                scope = {
+                    'type': 'http',
+                    'asgi': {'version': '3.0'},
+                    'http_version': version[5:],
+                    'method': method.upper(),
+                    'scheme': 'http',
+                    'path': parse.unquote(path),
+                    'raw_path': path.encode('latin1'),
+                    'query_string': query.encode('latin1'),
+                    'root_path': '',
+                    'headers': headers,
+                    'client': peer if isinstance(peer, tuple) else None,
+                    'server': sockname if isinstance(sockname, tuple) else None,
+                }
+                state = {'chunked': False, 'started': False, 'keep_alive': keep_alive}
+
+                async def receive():
+                    chunk = await body.read()
+                    return {'type': 'http.request', 'body': chunk, 'more_body': not body.done}
+
+                async def send(message):
+                    if message['type'] == 'http.response.start':
+                        status = message['status']
+                        lines = ['%s %d %s' % (version, status, HTTP_CODES.get(status, 'UNKNOWN'))]
+                        names = set()
+                        for name, value in message.get('headers', []):
+                            names.add(name.lower())
+                            lines.append('%s: %s' % (name.decode('latin1'), value.decode('latin1')))
+                        if b'content-length' not in names and status not in (204, 304) and method != 'HEAD':
+                            if version == 'HTTP/1.1':
+                                state['chunked'] = True
+                                lines.append('Transfer-Encoding: chunked')
+                            else:
+                                state['keep_alive'] = False
+                        if b'date' not in names:
+                            lines.append('Date: %s' % email.utils.formatdate(usegmt=True))
+                        lines.append('Connection: %s' % ('keep-alive' if state['keep_alive'] else 'close'))
+                        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin1'))
+                        state['started'] = True
+                    elif message['type'] == 'http.response.body' and method != 'HEAD':
+                        data = message.get('body', b'')
+                        if state['chunked']:
+                            if data:
+                                writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+                            if not message.get('more_body', False):
+                                writer.write(b'0\r\n\r\n')
+                        elif data:
+                            writer.write(data)
+                        await writer.drain()
+
+                try:
+                    await handler(scope, receive, send)
+                except Exception:
+                    traceback.print_exc()
+                    if not state['started']:
+                        writer.write(b'HTTP/1.1 500 INTERNAL SERVER ERROR\r\nContent-Length: 0\r\n'
+                                     b'Connection: close\r\n\r\n')
+                    break
+                await writer.drain()
+                # 丢弃处理器没有读取的请求体，才能继续读取同一连接上的下一个请求
+                while not body.done:
+                    await body.read()
+                if not state['keep_alive']:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+class AsyncBodyReader(object):
+    """
+    从 asyncio 流中按块读取请求体，处理 Content-Length 和 chunked 编码
+    """
+
+    def __init__(self, reader, headers, chunk_size=65536):
+        self.reader = reader
+        self.chunk_size = chunk_size
+        self.chunked = b'chunked' in headers.get(b'transfer-encoding', b'').lower()
+        self.remaining = 0 if self.chunked else int(headers.get(b'content-length', b'0') or 0)
+        if self.remaining < 0:
+            raise ValueError('Invalid Content-Length')
+        self.done = not self.chunked and self.remaining <= 0
+
+    async def read(self):
+        if self.done:
+            return b''
+        if self.chunked:
+            if self.remaining == 0:
+                line = await self.reader.readline()
+                self.remaining = int(line.split(b';')[0].strip(), 16)
+                if self.remaining == 0:
+                    while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    self.done = True
+                    return b''
+            data = await self.reader.read(min(self.chunk_size, self.remaining))
+            if not data:
+                raise asyncio.IncompleteReadError(b'', self.remaining)
+            self.remaining -= len(data)
+            if self.remaining == 0:
+                await self.reader.readline()
+            return data
+        data = await self.reader.read(min(self.chunk_size, self.remaining))
+        if not data:
+            raise asyncio.IncompleteReadError(b'', self.remaining)
+        self.remaining -= len(data)
+        self.done = self.remaining <= 0
+        return data
+
+
 # Python3 不支持
 # class FapwsServer(ServerAdapter):
 #     def run(self, handler):
@@ -529,12 +2659,13 @@ class PasteServer(ServerAdapter):
 #         evwsgi.run()
 
 
-def run(server=WSGIRefServer, host='127.0.0.1', port=8080, optinmize=False, **kargs):
-    global OPTIMIZER
-
-    OPTIMIZER = bool(optinmize)
+def run(server=WSGIRefServer, host='127.0.0.1', port=8080, optinmize=False, route_cache=None, **kargs):
+    # optinmize 参数仅为兼容保留，路由前缀树不再需要重新排列路由
     quiet = bool('quiet' in kargs and kargs['quiet'])
 
+    if route_cache is not None:
+        ROUTE_CACHE.resize(route_cache)
+
     if isinstance(server, type) and issubclass(server, ServerAdapter):
         server = server(host=host, port=port, **kargs)
 
@@ -543,46 +2674,592 @@ def run(server=WSGIRefServer, host='127.0.0.1', port=8080, optinmize=False, **ka
 
     if not quiet:
         print('Server starting up (using %s)...' % repr(server))
-        print('Listening on http://%s:%d/' % (server.host, server.port))
+        if server.tcp:
+            print('Listening on http://%s:%d/' % (server.host, server.port))
+        else:
+            print('Listening on %s' % server.host)
         print('Use Ctrl-C to quit.')
         print()
 
     try:
-        server.run(WSGIHandler)
+        server.run(ASGIHandler if server.asgi else WSGIHandler)
     except KeyboardInterrupt:
         print('Shuting down...')
 
 
+# 负载测试
+def bench(server=HTTP11Server, path='/', concurrency=16, duration=5.0, warmup=0.5,
+          method='GET', headers=None, body=b'', timeout=10.0, **kargs):
+    """
+    在子进程中用 server 运行当前的路由，通过本地回环用 concurrency 个保持连接的客户端
+    持续发送请求 duration 秒，返回吞吐量、延迟百分位数和错误数量组成的字典
+    开始的 warmup 秒不计入结果，kargs 作为服务器的可选参数
+    客户端运行在本进程的 asyncio 事件循环中，不会与服务器争用同一个 GIL
+    """
+    listener = socket.create_server(('127.0.0.1', 0), backlog=max(128, concurrency))
+    listener.set_inheritable(True)
+    port = listener.getsockname()[1]
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            kargs.setdefault('access_log', False)
+            run(server=server, host='fd:%d' % listener.fileno(), quiet=True, **kargs)
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+    listener.close()
+
+    lines = ['%s %s HTTP/1.1' % (method.upper(), path), 'Host: 127.0.0.1:%d' % port]
+    lines.extend('%s: %s' % item for item in (headers or {}).items())
+    if body:
+        lines.append('Content-Length: %d' % len(body))
+    message = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin1') + body
+    try:
+        stats = asyncio.run(_bench_clients(port, message, method.upper(), concurrency, duration, warmup, timeout))
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+    latencies = sorted(stats.pop('latencies'))
+
+    def percentile(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3) if latencies else None
+
+    return {
+        'server': server.__name__ if isinstance(server, type) else repr(server),
+        'options': {key: value for key, value in kargs.items() if key != 'access_log'},
+        'path': path,
+        'concurrency': concurrency,
+        'duration': duration,
+        'requests': len(latencies),
+        'throughput': round(len(latencies) / duration, 1),
+        'latency_ms': {'p50': percentile(0.5), 'p90': percentile(0.9), 'p99': percentile(0.99),
+                       'max': round(latencies[-1] * 1000, 3) if latencies else None},
+        'errors': sum(stats['errors'].values()),
+        'error_types': stats['errors'],
+        'status': stats['status'],
+        'connections': stats['connections'],
+    }
+
+
+async def _bench_clients(port, message, method, concurrency, duration, warmup, timeout):
+    loop = asyncio.get_running_loop()
+    measure_from = loop.time() + warmup
+    deadline = measure_from + duration
+    stats = {'latencies': [], 'errors': {}, 'status': {}, 'connections': 0}
+
+    async def client():
+        reader = writer = None
+        while loop.time() < deadline:
+            start = loop.time()
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+                    stats['connections'] += 1
+                writer.write(message)
+                status, keep_alive = await asyncio.wait_for(_bench_response(reader, method), timeout)
+            except (OSError, EOFError, ValueError, asyncio.TimeoutError) as e:
+                # 预热阶段开始、测量期间才失败或者超时的请求同样计入错误
+                if loop.time() >= measure_from:
+                    name = type(e).__name__
+                    stats['errors'][name] = stats['errors'].get(name, 0) + 1
+                if writer is not None:
+                    writer.close()
+                reader = writer = None
+                continue
+            # 截止时仍在进行中的请求完成后同样计入，否则会漏掉最慢的那些请求
+            if start >= measure_from:
+                stats['latencies'].append(loop.time() - start)
+                stats['status'][status] = stats['status'].get(status, 0) + 1
+                if status >= 400:
+                    stats['errors']['HTTP %d' % status] = stats['errors'].get('HTTP %d' % status, 0) + 1
+            if not keep_alive:
+                writer.close()
+                reader = writer = None
+        if writer is not None:
+            writer.close()
+
+    await asyncio.gather(*[client() for i in range(concurrency)])
+    return stats
+
+
+async def _bench_response(reader, method):
+    """
+    读取一个完整的响应，返回 (状态码, 连接是否可以继续使用)
+    HEAD 请求以及 1xx、204 和 304 响应没有响应体
+    """
+    line = await reader.readline()
+    if not line:
+        raise EOFError('Connection closed by server')
+    version, status = line.split(None, 2)[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n'):
+            break
+        if not line:
+            raise EOFError('Connection closed by server')
+        name, _, value = line.decode('latin1').partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+    connection = headers.get('connection', '')
+    keep_alive = connection == 'keep-alive' or (version == b'HTTP/1.1' and connection != 'close')
+    status = int(status)
+    if method == 'HEAD' or status in (204, 304) or status < 200:
+        pass
+    elif 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif 'chunked' in headers.get('transfer-encoding', ''):
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.read()
+        keep_alive = False
+    return status, keep_alive
+
+
+# 测试客户端
+class TestClient(object):
+    """
+    进程内的测试客户端，构造 WSGI 环境变量后直接调用 WSGIHandler，不经过网络
+    响应中设置的 Cookie 保存在 cookies 中，之后的请求自动带上
+    例如：
+        client = TestClient()
+        client.post('/login', data={'name': 'tim', 'password': 'secret'})
+        res = client.get('/hello', query={'lang': 'zh'})
+        assert res.status == 200 and 'tim' in res.text
+    """
+    __test__ = False
+
+    def __init__(self, app=None, host='localhost', headers=None):
+        self.app = app or WSGIHandler
+        self.host = host
+        self.headers = dict(headers or {})
+        self.cookies = {}
+
+    def build_environ(self, path='/', method='GET', query=None, headers=None, cookies=None,
+                      body=b'', data=None, files=None, json=None):
+        """
+        构造 WSGI 环境变量字典
+        query 为查询参数，会追加到 path 中已有的查询字符串之后
+        请求体按优先级使用：
+            files  {name: (filename, content) 或 (filename, content, content_type)}，与 data 一起以 multipart 发送
+            data   表单字段字典或 (name, value) 列表，以 urlencoded 发送
+            json   任意可以序列化为 JSON 的对象
+            body   原始请求体（字节串或字符串）
+        """
+        path, _, query_string = path.partition('?')
+        if query:
+            extra = parse.urlencode(query, doseq=True)
+            query_string = query_string + '&' + extra if query_string else extra
+        headers = dict(self.headers, **(headers or {}))
+        content_type = None
+        if files:
+            boundary = 'my_bottle-%s' % os.urandom(16).hex()
+            body = self.encode_multipart(data or {}, files, boundary)
+            content_type = 'multipart/form-data; boundary=%s' % boundary
+        elif data is not None:
+            body = parse.urlencode(data, doseq=True).encode('utf-8')
+            content_type = 'application/x-www-form-urlencoded'
+        elif json is not None:
+            body = JSON_ENCODER.encode(json).encode('utf-8')
+            content_type = 'application/json'
+        elif isinstance(body, str):
+            body = body.encode('utf-8')
+        if content_type and not any(key.lower() == 'content-type' for key in headers):
+            headers['Content-Type'] = content_type
+
+        environ = {
+            'REQUEST_METHOD': method.upper(),
+            'SCRIPT_NAME': '',
+            'PATH_INFO': parse.unquote(path, 'latin1'),
+            'QUERY_STRING': query_string,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REMOTE_ADDR': '127.0.0.1',
+            'HTTP_HOST': self.host,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for key, value in headers.items():
+            key = key.upper().replace('-', '_')
+            environ[key if key in ('CONTENT_TYPE', 'CONTENT_LENGTH') else 'HTTP_' + key] = str(value)
+        jar = dict(self.cookies, **(cookies or {}))
+        if jar:
+            environ['HTTP_COOKIE'] = '; '.join('%s=%s' % item for item in jar.items())
+        return environ
+
+    @staticmethod
+    def encode_multipart(data, files, boundary):
+        """
+        把表单字段和文件编码为 multipart/form-data 请求体
+        """
+        parts = []
+        fields = data.items() if isinstance(data, dict) else data
+        for name, value in fields:
+            for item in value if isinstance(value, (list, tuple)) else [value]:
+                parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n' % (boundary, name)).encode('utf-8'))
+                parts.append(item if isinstance(item, bytes) else str(item).encode('utf-8'))
+                parts.append(b'\r\n')
+        for name, spec in files.items():
+            filename, content = spec[0], spec[1]
+            content_type = spec[2] if len(spec) > 2 else (mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+            if hasattr(content, 'read'):
+                content = content.read()
+            parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                          'Content-Type: %s\r\n\r\n' % (boundary, name, filename, content_type)).encode('utf-8'))
+            parts.append(content if isinstance(content, bytes) else content.encode('utf-8'))
+            parts.append(b'\r\n')
+        parts.append(('--%s--\r\n' % boundary).encode('utf-8'))
+        return b''.join(parts)
+
+    def request(self, path='/', method='GET', **kargs):
+        """
+        发送一个请求，返回 TestResponse，参数与 build_environ 相同
+        """
+        environ = self.build_environ(path, method, **kargs)
+        captured = []
+
+        def start_response(status, headers, exc_info=None):
+            captured[:] = [status, headers]
+
+        output = self.app(environ, start_response)
+        try:
+            body = b''.join(output)
+        finally:
+            if hasattr(output, 'close'):
+                output.close()
+        res = TestResponse(captured[0], captured[1], body)
+        self.store_cookies(res.headers.get('Set-Cookie') or [])
+        return res
+
+    def store_cookies(self, values):
+        """
+        根据 Set-Cookie 标头更新 cookies，Max-Age=0 或者已经过期的 Cookie 被删除
+        """
+        for value in values if isinstance(values, list) else [values]:
+            for morsel in http.cookies.SimpleCookie(value).values():
+                expired = morsel['max-age'] in ('0', '-1')
+                if morsel['expires'] and not expired:
+                    try:
+                        expired = email.utils.parsedate_to_datetime(morsel['expires']).timestamp() < time.time()
+                    except (TypeError, ValueError):
+                        pass
+                if expired:
+                    self.cookies.pop(morsel.key, None)
+                else:
+                    self.cookies[morsel.key] = morsel.value
+
+    def get(self, path='/', **kargs):
+        return self.request(path, 'GET', **kargs)
+
+    def post(self, path='/', **kargs):
+        return self.request(path, 'POST', **kargs)
+
+    def put(self, path='/', **kargs):
+        return self.request(path, 'PUT', **kargs)
+
+    def delete(self, path='/', **kargs):
+        return self.request(path, 'DELETE', **kargs)
+
+    def head(self, path='/', **kargs):
+        return self.request(path, 'HEAD', **kargs)
+
+
+class TestResponse(object):
+    """
+    TestClient 收到的响应
+    headers 对键值大小写不敏感，同名的多个标头（例如 Set-Cookie）保存为列表
+    """
+    __test__ = False
+
+    def __init__(self, status_line, headerlist, body):
+        self.status_line = status_line
+        self.status = int(status_line.split()[0])
+        self.headerlist = headerlist
+        self.headers = HeaderDict()
+        for key, value in headerlist:
+            if key in self.headers:
+                self.headers.add(key, value)
+            else:
+                self.headers[key] = value
+        self.body = body
+
+    @property
+    def text(self):
+        """
+        按 Content-Type 中声明的字符集解码的响应体
+        """
+        charset = parse_header_params(self.headers.get('Content-Type') or '')[1].get('charset', 'utf-8')
+        return self.body.decode(charset)
+
+    def json(self):
+        return json.loads(self.body)
+
+    def __repr__(self):
+        return '<TestResponse %s (%d bytes)>' % (self.status_line, len(self.body))
+
+
 # 模板
 class BaseTemplate(object):
-    def __init__(self, template):
-        self.code = self.compile(template)
-        self.co = compile(self.code, '<string>', 'exec')
+    """
+    模板基类，子类通过 compile() 把模板源码翻译为 Python 代码
+    生成的代码被包装成生成器函数，在刷新点产出已经渲染的内容
+    version 参与字节码缓存的键值，模板语法变化时需要增加
+    flush_size 为流式渲染时每次产出前累积的片段数量
+    """
+    version = 4
+    flush_size = 256
+
+    def __init__(self, template='', filename=None, co=None, dependencies=()):
+        self.filename = filename
+        # 编译时被内联的其他模板文件，任何一个发生变化都需要重新编译
+        self.dependencies = list(dependencies)
+        if co is None:
+            self.code = self.wrap(self.compile(template))
+            self.co = compile(self.code, filename or '<string>', 'exec')
+        else:
+            self.code = None
+            self.co = co
 
     def compile(self, template):
         pass
 
-    def render(self, **args):
+    def stamps(self):
+        """
+        返回模板文件及其依赖文件的 (路径, 修改时间, 大小) 列表
+        """
+        stamps = []
+        for filename in [self.filename] + self.dependencies:
+            try:
+                stats = os.stat(filename)
+                stamps.append((filename, stats.st_mtime_ns, stats.st_size))
+            except (OSError, TypeError):
+                stamps.append((filename, None, None))
+        return stamps
+
+    def wrap(self, code):
+        """
+        把模板代码包装成生成器函数 __template__
+        模板参数作为全局变量，在模板中被重新赋值的参数需要在函数开头取出
+        """
+        def build(names):
+            lines = ['def __template__(__args__):']
+            for name in names:
+                lines.append("    if %r in __args__: %s = __args__[%r]" % (name, name, name))
+            lines.extend('    ' + line for line in code.splitlines())
+            lines.append("    if stdout: yield ''.join(stdout)")
+            return '\n'.join(lines)
+
+        func = [c for c in compile(build(()), '<string>', 'exec').co_consts if hasattr(c, 'co_varnames')][0]
+        names = [n for n in func.co_varnames + func.co_cellvars if n != '__args__']
+        return build(names)
+
+    def render_iter(self, **args):
+        """
+        流式渲染模板，返回在刷新点产出字符串片段的生成器
+        """
         args['stdout'] = []
         args['__builtins__'] = builtins
-        eval(self.co, {}, args)
-        return ''.join(args['stdout'])
+        args.setdefault('_flush_size', self.flush_size)
+        args['_fragments'] = FRAGMENTS
+        eval(self.co, args)
+        return args['__template__'](args)
+
+    def render(self, **args):
+        args['_flush_size'] = sys.maxsize
+        with request.timer('template'):
+            return ''.join(self.render_iter(**args))
+
+    @classmethod
+    def cache_file(cls, filename, cache_dir):
+        """
+        返回模板对应的字节码缓存文件路径
+        """
+        key = '%s:%s' % (cls.__name__, os.path.abspath(filename))
+        return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.tplc')
+
+    @classmethod
+    def cache_key(cls, filename):
+        """
+        返回字节码缓存的校验键：解释器版本、模板引擎版本、模板路径和修改时间
+        """
+        stats = os.stat(filename)
+        return (importlib.util.MAGIC_NUMBER, cls.__name__, cls.version,
+                os.path.abspath(filename), stats.st_mtime_ns, stats.st_size)
+
+    @classmethod
+    def load(cls, filename, cache_dir=None):
+        """
+        从文件加载模板
+        指定 cache_dir 时优先读取磁盘上的字节码缓存，缓存失效则重新编译并写回
+        """
+        if not cache_dir:
+            with open(filename, 'r', encoding='utf-8') as fp:
+                return cls(fp.read(), filename=filename)
+
+        key = cls.cache_key(filename)
+        cache_file = cls.cache_file(filename, cache_dir)
+        try:
+            with open(cache_file, 'rb') as fp:
+                cached_key, co, stamps = marshal.load(fp)
+            if cached_key == key:
+                tpl = cls(filename=filename, co=co, dependencies=[stamp[0] for stamp in stamps[1:]])
+                if tpl.stamps() == [tuple(stamp) for stamp in stamps]:
+                    return tpl
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+        with open(filename, 'r', encoding='utf-8') as fp:
+            tpl = cls(fp.read(), filename=filename)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # 先写临时文件再替换，避免多个进程同时启动时读到不完整的缓存
+            tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+            with open(tmp_file, 'wb') as fp:
+                marshal.dump((key, tpl.co, tpl.stamps()), fp)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass
+        return tpl
 
 
 class SimpleTemplate(BaseTemplate):
+    """
+    简单模板引擎
+
+    以 % 开头的行是 Python 代码，{{expr}} 输出表达式的值
+    % include name key=value ... 在编译时内联另一个模板，参数和其中的赋值不会改变当前模板的变量
+    % rebase name key=value ... 把当前模板内联到布局模板中 % base 所在的位置，单独渲染布局模板时 % base 不输出任何内容
+    % cache key, ttl ... % end 缓存语句块的渲染结果
+    % flush 在流式渲染时立即输出已经渲染的内容
+    """
     re_block = re.compile(r'^\s*%\s*((if|elif|else|try|except|finally|for|while|with).*:)\s*$')
     re_end = re.compile(r'^\s*%\s*end(.*?)\s*$')
     re_code = re.compile(r'^\s*%\s*(.*?)\s*$')
     re_inc = re.compile(r'\{\{(.*?)\}\}')
+    re_flush = re.compile(r'^\s*%\s*flush\s*$')
+    # 名为 cache 的变量的赋值、下标和属性访问是普通代码
+    re_cache = re.compile(r'^\s*%\s*cache\s+(?![=:\[.]|(?:[-+*/%@&|^]|//|\*\*|>>|<<)=)(.+?)\s*$')
+    re_include = re.compile(r'^\s*%\s*(include|rebase)\s+([^\s,=\[.][^\s,]*)\s*,?\s*(.*?)\s*$')
+    re_base = re.compile(r'^\s*%\s*base\s*$')
+    # 布局模板中 % base 的位置，内联子模板时被替换
+    base_marker = '# base'
+    dedent_blocks = ('elif', 'else', 'except', 'finally')
 
     def compile(self, template):
-        return "\n".join(self._compile(template))
+        self._fragment_count = 0
+        self._scope_count = 0
+        filename = os.path.abspath(self.filename) if self.filename else None
+        return "\n".join(self._compile(template, 0, filename, (), False, None))
+
+    def _load_source(self, name, filename, stack):
+        """
+        查找被包含的模板并记录依赖，返回 (文件路径, 模板源码)
+        优先在当前模板所在目录查找，然后是 TEMPLATE_PATH
+        """
+        lookup = [os.path.dirname(filename)] if filename else []
+        path = find_template(name, lookup + TEMPLATE_PATH)
+        if path in stack or path == filename:
+            raise TemplateError('Recursive include of "%s"' % name)
+        if path not in self.dependencies:
+            self.dependencies.append(path)
+        with open(path, 'r', encoding='utf-8') as fp:
+            return path, fp.read()
+
+    def _compile(self, template, level, filename, stack, in_cache, base):
+        """
+        把模板源码翻译为 level 缩进级别的代码行列表
+        base 为布局模板中 % base 处需要内联的子模板代码
+        """
+        rebase = []
+        code = list(self._translate(template, level, filename, stack, in_cache, base, rebase))
+        if not rebase:
+            return code
+        # 子模板先按当前缩进翻译，再去掉缩进内联到布局模板中
+        name, args, line_no = rebase[0]
+        path, source = self._load_source(name, filename, stack)
+        args = list(self._code_args(level, line_no, args))
+        layout = list(self._compile(source, level, path, stack + (filename,), in_cache, [self.base_marker]))
+        # 子模板看到的是 rebase 之前的变量，布局模板的参数和赋值在 % base 处换出，之后再换回
+        names = self._assigned_names(args + layout, level)
+        outer = self._next_scope()
+        result = list(self._code_save(level, outer, names, line_no)) + args
+        for line in layout:
+            if line.strip() != self.base_marker:
+                result.append(line)
+                continue
+            base_level = (len(line) - len(line.lstrip())) // 4
+            inner = self._next_scope()
+            result.extend(self._code_save(base_level, inner, names, line_no))
+            result.extend(self._code_restore(base_level, outer, names))
+            result.extend('    ' * (base_level - level) + line for line in code)
+            result.extend(self._code_restore(base_level, inner, names))
+        return result
+
+    def _next_scope(self):
+        self._scope_count += 1
+        return '_scope_%d' % self._scope_count
+
+    @staticmethod
+    def _assigned_names(code, level):
+        """
+        返回内联的代码中赋值的变量名，不包括编译器生成的内部变量
+        """
+        indent = len('    ' * level)
+        source = '\n'.join(['def _():'] + ['    ' + line[indent:] for line in code] + ['    pass'])
+        func = [c for c in compile(source, '<string>', 'exec').co_consts if hasattr(c, 'co_varnames')][0]
+        return sorted(name for name in set(func.co_varnames + func.co_cellvars)
+                      if not name.startswith(('_scope_', '_fragment_')))
+
+    @staticmethod
+    def _code_save(level, scope, names, line):
+        """
+        内联其他模板前保存当前的变量，names 为空时不需要保存
+        """
+        if names:
+            yield '    ' * level + '%s = dict(locals()) # Line: %d' % (scope, line)
+
+    @staticmethod
+    def _code_restore(level, scope, names):
+        """
+        恢复 _code_save() 保存的变量，之前不存在的变量被删除
+        """
+        for name in names:
+            yield '    ' * level + 'if %r in %s: %s = %s[%r]' % (name, scope, name, scope, name)
+            yield '    ' * level + 'elif %r in locals(): del %s' % (name, name)
 
-    def _compile(self, template):
+    def _code_args(self, level, line, value):
+        """
+        include / rebase 的参数在内联代码之前赋值为普通变量
+        """
+        source = 'f(%s)' % value
+        try:
+            call = ast.parse(source, mode='eval').body
+        except SyntaxError:
+            raise TemplateError('Invalid template arguments in line %d: %s' % (line, value))
+        if call.args or any(keyword.arg is None for keyword in call.keywords):
+            raise TemplateError('Template arguments must be keywords in line %d: %s' % (line, value))
+        for keyword in call.keywords:
+            yield '    ' * level + '%s = %s # Line: %d' % (
+                keyword.arg, ast.get_source_segment(source, keyword.value), line)
+
+    def _translate(self, template, level, filename, stack, in_cache, base, rebase):
         def code_str(level, line, value):
             value = "".join(value)
-            value = value.replace("'", "\'").replace('\\', '\\\\')
-            return '    ' * level + "stdout.append(r'''%s''')" % value
+            return '    ' * level + "stdout.append(%r)" % value
 
         def code_print(level, line, value):
             return '    ' * level + "stdout.append(str(%s)) # Line: %d" % (value.strip(), line)
@@ -590,40 +3267,220 @@ class SimpleTemplate(BaseTemplate):
         def code_raw(level, line, value):
             return '    ' * level + value.strip() + ' # Line: %d' % line
 
+        def code_flush(level, line, force=False):
+            if force:
+                return '    ' * level + "yield ''.join(stdout); del stdout[:] # Line: %d" % line
+            return '    ' * level + "if len(stdout) >= _flush_size: yield ''.join(stdout); del stdout[:] # Line: %d" % line
+
+        def code_cache(level, line, value, index):
+            var = '_fragment_%d' % index
+            yield '    ' * level + "%s_key, %s_ttl = _fragments.parse_args(%s) # Line: %d" % (var, var, value, line)
+            yield '    ' * level + "%s = _fragments.get_fragment(%s_key)" % (var, var)
+            yield '    ' * level + "if %s is not None:" % var
+            yield '    ' * (level + 1) + "stdout.append(%s)" % var
+            yield '    ' * level + "else:"
+            yield '    ' * (level + 1) + "%s_mark = len(stdout)" % var
+
+        def code_cache_end(level, line, index):
+            var = '_fragment_%d' % index
+            return '    ' * level + "_fragments.set_fragment(%s_key, ''.join(stdout[%s_mark:]), %s_ttl) # Line: %d" % (
+                var, var, var, line)
+
+        blocks = []
+        fragments = []
+        strbuffer = []
+        line_no = 0
+        for line_no, line in enumerate(template.splitlines(True), 1):
+            if line.lstrip().startswith('%'):
+                if strbuffer:
+                    yield code_str(level, line_no, strbuffer)
+                    strbuffer = []
+                m_block = self.re_block.match(line)
+                m_end = self.re_end.match(line)
+                m_include = self.re_include.match(line)
+                if m_block:
+                    if m_block.group(2) in self.dedent_blocks:
+                        level -= 1
+                        if blocks:
+                            blocks.pop()
+                    if level < 0:
+                        raise TemplateError('Unexpected "%s" in line %d' % (m_block.group(2), line_no))
+                    yield code_raw(level, line_no, m_block.group(1))
+                    # 空语句块也需要一条语句才能通过编译
+                    yield code_raw(level + 1, line_no, 'pass')
+                    blocks.append(m_block.group(2))
+                    level += 1
+                elif m_end:
+                    if not blocks:
+                        raise TemplateError('Unexpected "end" in line %d' % line_no)
+                    block = blocks.pop()
+                    if block == 'cache':
+                        yield code_cache_end(level, line_no, fragments.pop())
+                    elif block in ('for', 'while') and not in_cache and 'cache' not in blocks:
+                        # 每次循环结束都是一个刷新点，长列表可以边渲染边输出
+                        # 缓存片段内部不能刷新，否则无法取得片段的完整输出
+                        yield code_flush(level, line_no)
+                    level -= 1
+                elif m_include and m_include.group(1) == 'include':
+                    path, source = self._load_source(m_include.group(2), filename, stack)
+                    inlined = list(self._code_args(level, line_no, m_include.group(3)))
+                    inlined.extend(self._compile(source, level, path, stack + (filename,),
+                                                 in_cache or 'cache' in blocks, None))
+                    # 被包含的模板的参数和赋值不能改变当前模板的变量
+                    names = self._assigned_names(inlined, level)
+                    scope = self._next_scope()
+                    for code in itertools.chain(self._code_save(level, scope, names, line_no), inlined,
+                                                self._code_restore(level, scope, names)):
+                        yield code
+                elif m_include:
+                    if rebase:
+                        raise TemplateError('Only one "rebase" allowed, line %d' % line_no)
+                    rebase.append((m_include.group(2), m_include.group(3), line_no))
+                elif self.re_base.match(line):
+                    # 单独编译布局模板时（如预编译整个目录）没有需要内联的内容
+                    for code in base or ():
+                        yield '    ' * level + code
+                elif self.re_cache.match(line):
+                    self._fragment_count += 1
+                    for code in code_cache(level, line_no, self.re_cache.match(line).group(1),
+                                           self._fragment_count):
+                        yield code
+                    blocks.append('cache')
+                    fragments.append(self._fragment_count)
+                    level += 1
+                elif self.re_flush.match(line):
+                    if not in_cache and 'cache' not in blocks:
+                        yield code_flush(level, line_no, force=True)
+                else:
+                    yield code_raw(level, line_no, self.re_code.match(line).group(1))
+                continue
+
+            parts = self.re_inc.split(line)
+            for i, part in enumerate(parts):
+                if i % 2 == 0:
+                    if part:
+                        strbuffer.append(part)
+                else:
+                    if strbuffer:
+                        yield code_str(level, line_no, strbuffer)
+                        strbuffer = []
+                    yield code_print(level, line_no, part)
+        if strbuffer:
+            yield code_str(level, line_no, strbuffer)
 
-# 默认错误处理器
-@error(500)
-def error500(exception):
-    if DEBUG:
-        return "<br>\n".join(traceback.format_exc(10).splitlines()).replace('  ', '&nbsp;&nbsp;')
-    else:
-        return """<b>Error:</b> Internal server error."""
 
+def compile_templates(path, cache_dir, ext='.tpl', template_class=None):
+    """
+    预编译目录下的所有模板并写入字节码缓存，返回编译的模板数量
+    通常在部署或工作进程启动前调用一次
+    """
+    template_class = template_class or SimpleTemplate
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            if name.endswith(ext):
+                template_class.load(os.path.join(dirpath, name), cache_dir)
+                count += 1
+    return count
 
-@error(400)
-@error(401)
-@error(404)
-def error_http(exception):
-    status = response.status
-    name = HTTP_CODES.get(status, 'Unknown').title()
-    url = request.path
-    yield '<!DOCTYPE HTML PUBLIC "-//IETF//DTD HTML 2.0//EN">'
-    yield '<html><head><title>Error %d: %s</title>' % (status, name)
-    yield '</head><body><h1>Error %d: %s</h1>' % (status, name)
-    yield '<p>Sorry, the requested URL %s caused an error.</p>' % url
-    if hasattr(exception, 'output'):
-        yield exception.output
-    yield '</body></html>'
+
+def find_template(name, lookup=None):
+    """
+    在 lookup（默认为 TEMPLATE_PATH）的各个目录中依次查找模板文件，返回绝对路径
+    """
+    if not name.endswith('.tpl'):
+        name = '%s.tpl' % name
+    if lookup is None:
+        lookup = TEMPLATE_PATH
+    for path in lookup:
+        filename = os.path.join(path, name)
+        if os.path.isfile(filename):
+            return os.path.abspath(filename)
+    raise TemplateError('Template "%s" not found in %s' % (name, lookup))
+
+
+def load_template(name):
+    """
+    返回编译好的模板对象，优先使用 TEMPLATES 缓存
+
+    距上次检查超过 TEMPLATE_CHECK_INTERVAL 秒时比较模板文件及其内联的模板文件的修改时间，
+    任何一个文件发生变化则重新编译；TEMPLATE_CHECK_INTERVAL 为 None 时从不检查
+    """
+    now = time.time()
+    entry = TEMPLATES.get(name)
+    if entry is not None:
+        tpl, stamps, checked = entry
+        if TEMPLATE_CHECK_INTERVAL is None or now - checked < TEMPLATE_CHECK_INTERVAL:
+            return tpl
+        if tpl.stamps() == stamps:
+            entry[2] = now
+            return tpl
+
+    tpl = TEMPLATE_GENERATOR(find_template(name))
+    TEMPLATES.put(name, [tpl, tpl.stamps(), now])
+    return tpl
+
+
+def template(name, **args):
+    """
+    渲染一个模板并返回结果字符串
+    """
+    return load_template(name).render(**args)
 
 
-request = Request()
-response = Response()
+def preload_templates():
+    """
+    加载 TEMPLATE_PATH 中的所有模板到缓存，返回加载的模板数量
+    通常在工作进程启动时调用，避免第一次请求时才编译模板
+    """
+    count = 0
+    for path in TEMPLATE_PATH:
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                if filename.endswith('.tpl'):
+                    name = os.path.relpath(os.path.join(dirpath, filename), path)[:-4]
+                    if name not in TEMPLATES:
+                        load_template(name)
+                        count += 1
+    return count
+
+
+# 当前线程或 asyncio 任务正在处理的请求和响应对象
+REQUEST_CONTEXT = contextvars.ContextVar('request')
+RESPONSE_CONTEXT = contextvars.ContextVar('response')
+request = ContextLocal(Request, REQUEST_CONTEXT)
+response = ContextLocal(Response, RESPONSE_CONTEXT)
 DEBUG = False
-OPTIMIZER = False
-TEMPLATE_GENERATOR = lambda x: SimpleTemplate(open('./%s.tpl' % x, 'r').read())
-TEMPLATES = {}
+DEFAULT_CONTENT_TYPE = 'text/html; charset=UTF-8'
+JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+JSON_STREAM_SIZE = 1000
+TEMPLATE_CACHE_DIR = None
+TEMPLATE_PATH = ['./']
+TEMPLATE_CHECK_INTERVAL = 1.0
+TEMPLATE_GENERATOR = lambda filename: SimpleTemplate.load(filename, TEMPLATE_CACHE_DIR)
+TEMPLATES = LRUCache(256)
+FRAGMENTS = FragmentCache(1024)
+STAT_CACHE = LRUCache(1024)
+STAT_CACHE_TTL = 1.0
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+GZIP_MIN_SIZE = None
+GZIP_LEVEL = 6
+GZIP_CONTENT_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+GZIP_CACHE = LRUCache(128)
+MEMFILE_MAX = 102400
+MAX_FIELD_SIZE = 1024 * 1024
+MAX_PART_SIZE = 100 * 1024 * 1024
+MAX_BODY_SIZE = 100 * 1024 * 1024
+MAX_PARTS = 1000
 ROUTES_SIMPLE = {}
 ROUTES_REGEXP = {}
+ROUTES_TREE = {}
+ROUTE_CACHE = LRUCache(0)
+METRICS = None
+SERVER_TIMING = False
+SLOW_REQUEST_THRESHOLD = None
+SLOW_REQUEST_LOG = None
+NULL_TIMER = contextlib.nullcontext()
 ERROR_HANDLER = {}
 HTTP_CODES = {
     100: 'CONTINUE',
@@ -668,3 +3525,70 @@ HTTP_CODES = {
     504: 'GATEWAY TIMEOUT',
     505: 'HTTP VERSION NOT SUPPORTED',
 }
+
+
+# 默认错误处理器
+@error(500)
+def error500(exception):
+    if DEBUG:
+        return "<br>\n".join(traceback.format_exc(10).splitlines()).replace('  ', '&nbsp;&nbsp;')
+    else:
+        return """<b>Error:</b> Internal server error."""
+
+
+@error(400)
+@error(401)
+@error(404)
+@error(413)
+def error_http(exception):
+    status = response.status
+    name = HTTP_CODES.get(status, 'Unknown').title()
+    url = request.path
+    yield '<!DOCTYPE HTML PUBLIC "-//IETF//DTD HTML 2.0//EN">'
+    yield '<html><head><title>Error %d: %s</title>' % (status, name)
+    yield '</head><body><h1>Error %d: %s</h1>' % (status, name)
+    yield '<p>Sorry, the requested URL %s caused an error.</p>' % url
+    if hasattr(exception, 'output'):
+        yield exception.output
+    yield '</body></html>'
+
+
+# 命令行
+def main(argv=None):
+    """
+    python -m my_bottle bench [--server HTTP11Server] [--concurrency 16] [--duration 5] [-o threads=32] ...
+    没有指定 --app 时使用一个简单的示例应用，结果以 JSON 格式输出
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m my_bottle')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('bench', help='load test a server adapter over loopback')
+    command.add_argument('--server', default='HTTP11Server', help='name of a ServerAdapter subclass')
+    command.add_argument('--path', default='/', help='request path, may include a query string')
+    command.add_argument('--method', default='GET')
+    command.add_argument('--concurrency', '-c', type=int, default=16, help='number of keep-alive clients')
+    command.add_argument('--duration', '-d', type=float, default=5.0, help='seconds to measure')
+    command.add_argument('--warmup', type=float, default=0.5, help='seconds to run before measuring')
+    command.add_argument('--app', help='module to import instead of the sample app')
+    command.add_argument('--option', '-o', action='append', default=[], metavar='KEY=VALUE',
+                         help='option passed to the server adapter')
+    args = parser.parse_args(argv)
+
+    server = globals().get(args.server)
+    if not (isinstance(server, type) and issubclass(server, ServerAdapter)):
+        parser.error('unknown server adapter: %s' % args.server)
+    options = dict(option.split('=', 1) for option in args.option)
+    if args.app:
+        importlib.import_module(args.app)
+    else:
+        add_route('/', lambda: 'Hello World!')
+        add_route('/hello/:name', lambda name: 'Hello %s!' % name)
+        add_route('/json', lambda: {'hello': 'world', 'numbers': list(range(10))})
+    result = bench(server, args.path, args.concurrency, args.duration, args.warmup, args.method, **options)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    # 通过模块本身运行，使 --app 中 import my_bottle 注册的路由与服务器使用同一个模块
+    import my_bottle
+    my_bottle.main()
@@ -0,0 +1,1474 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""
+my_bottle 的测试，使用 pytest 运行：
+    python -m pytest -q
+
+请求级测试通过 TestClient 在进程内调用 WSGIHandler，服务器适配器的测试在子进程中启动真实的服务器
+"""
+
+import asyncio
+import contextlib
+import gzip
+import http.client
+import io
+import json
+import mimetypes
+import os
+import re
+import signal
+import socket
+import stat
+import subprocess
+import sys
+import threading
+import time
+import warnings
+
+import pytest
+
+import my_bottle
+from my_bottle import SimpleTemplate, TemplateError, TestClient, request, response
+
+
+@pytest.fixture
+def routes(monkeypatch):
+    """
+    使用空的路由表，返回 route 装饰器
+    """
+    monkeypatch.setattr(my_bottle, 'ROUTES_SIMPLE', {})
+    monkeypatch.setattr(my_bottle, 'ROUTES_REGEXP', {})
+    monkeypatch.setattr(my_bottle, 'ROUTES_TREE', {})
+    monkeypatch.setattr(my_bottle, 'ROUTE_CACHE', my_bottle.LRUCache(0))
+    monkeypatch.setattr(my_bottle, 'STAT_CACHE', my_bottle.LRUCache(1024))
+    return my_bottle.route
+
+
+@pytest.fixture
+def client(routes):
+    return TestClient()
+
+
+@contextlib.contextmanager
+def live_server(server, host=None, **kargs):
+    """
+    在子进程中用 server 运行当前的路由，返回监听的端口
+    没有指定 host 时监听本地回环的随机端口
+    """
+    listener = None
+    if host is None:
+        listener = socket.create_server(('127.0.0.1', 0))
+        listener.set_inheritable(True)
+        host = 'fd:%d' % listener.fileno()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            my_bottle.run(server=server, host=host, quiet=True, access_log=False, **kargs)
+        finally:
+            os._exit(0)
+    port = None
+    if listener is not None:
+        port = listener.getsockname()[1]
+        listener.close()
+    try:
+        yield port
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+
+def raw_request(port, data, timeout=5):
+    """
+    发送原始请求数据，读取到服务器关闭连接为止
+    """
+    with socket.create_connection(('127.0.0.1', port), timeout=timeout) as sock:
+        sock.sendall(data)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+
+def asgi_request(path, method='GET', body=b'', headers=()):
+    """
+    直接调用 ASGIHandler，返回 (状态码, 标头字典, 响应体)
+    """
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query.encode('latin1'),
+             'headers': [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in headers]}
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    async def call():
+        await my_bottle.ASGIHandler(scope, receive, send)
+        start = sent[0]
+        return (start['status'], {k.decode('latin1'): v.decode('latin1') for k, v in start['headers']},
+                b''.join(m.get('body', b'') for m in sent[1:]))
+
+    return call()
+
+
+def call(url, method='GET'):
+    handler, args = my_bottle.match_url(url, method)
+    return handler(**args)
+
+
+# 路由
+def test_route_placeholders(routes):
+    routes('/user/:id#[0-9]+#')(lambda id: 'id %s' % id)
+    routes('/user/:name')(lambda name: 'name %s' % name)
+    routes('/files/:path#.+#')(lambda path: 'path %s' % path)
+    routes('/raw/(?P<word>[a-z]+)/(?P<n>\\d+)')(lambda word, n: 'raw %s %s' % (word, n))
+    routes('/static')(lambda: 'static')
+    assert call('/user/5') == 'id 5'
+    assert call('/user/tim') == 'name tim'
+    assert call('/files/a/b/c.txt') == 'path a/b/c.txt'
+    assert call('/raw/abc/12') == 'raw abc 12'
+    assert call('/static') == 'static'
+    for url in ('/user', '/user/5/6', '/raw/ABC/12', '/nothing'):
+        with pytest.raises(my_bottle.HTTPError):
+            my_bottle.match_url(url)
+
+
+def test_route_first_added_wins(routes):
+    routes('/a/:rest#.+#')(lambda rest: 'first')
+    routes('/a/:x/c')(lambda x: 'second')
+    routes('/b/:x/c')(lambda x: 'third')
+    routes('/b/:rest#.+#')(lambda rest: 'fourth')
+    assert call('/a/b/c') == 'first'
+    assert call('/b/x/c') == 'third'
+    assert call('/b/x/d') == 'fourth'
+
+
+def test_route_many_routes(routes):
+    for i in range(1000):
+        routes('/user%d/:id#[0-9]+#/:action' % i)(lambda id, action, i=i: (i, id, action))
+    assert call('/user999/42/edit') == (999, '42', 'edit')
+    assert call('/user0/1/view') == (0, '1', 'view')
+    with pytest.raises(my_bottle.HTTPError):
+        my_bottle.match_url('/user1000/1/view')
+
+
+def test_route_methods(client, routes):
+    routes('/item/:id')(lambda id: 'get %s' % id)
+    routes('/item/:id', method='post')(lambda id: 'post %s' % id)
+    assert client.get('/item/1').text == 'get 1'
+    assert client.post('/item/1').text == 'post 1'
+    assert client.delete('/item/1').status == 404
+
+
+def test_route_cache(routes, monkeypatch):
+    cache = my_bottle.LRUCache(2)
+    monkeypatch.setattr(my_bottle, 'ROUTE_CACHE', cache)
+    routes('/hello/:name')(lambda name: name)
+    for url in ('/hello/a', '/hello/a', '/hello/b', '/hello/c'):
+        my_bottle.match_url(url)
+    assert cache.stats() == {'size': 2, 'maxsize': 2, 'hits': 1, 'misses': 3, 'evictions': 1}
+    # 返回的参数字典是副本，修改它不会影响缓存
+    my_bottle.match_url('/hello/c')[1]['name'] = 'changed'
+    assert my_bottle.match_url('/hello/c')[1] == {'name': 'c'}
+    # 添加路由后缓存失效，新的路由可以覆盖之前没有匹配的 url
+    routes('/hello/:name/:more')(lambda name, more: more)
+    assert len(cache) == 0
+    assert my_bottle.match_url('/hello/c/d')[1] == {'name': 'c', 'more': 'd'}
+
+
+def test_route_cache_size_from_run(monkeypatch):
+    cache = my_bottle.LRUCache(0)
+    monkeypatch.setattr(my_bottle, 'ROUTE_CACHE', cache)
+
+    class NullServer(my_bottle.ServerAdapter):
+        def run(self, handler):
+            pass
+
+    my_bottle.run(NullServer, quiet=True, route_cache=64)
+    assert cache.maxsize == 64
+
+
+# 请求和响应
+def test_context_isolated_between_tasks(routes):
+    @routes('/task/:name')
+    async def handler(name):
+        response.header['X-Name'] = name
+        await asyncio.sleep(0.01 if name == 'a' else 0)
+        return '%s %s %s' % (name, request.path, request.GET['q'])
+
+    async def main():
+        return await asyncio.gather(*[asgi_request('/task/%s?q=%s' % (name, name)) for name in 'abc'])
+
+    for name, (status, headers, body) in zip('abc', asyncio.run(main())):
+        assert status == 200
+        assert headers['x-name'] == name
+        assert body == ('%s /task/%s %s' % (name, name, name)).encode()
+
+
+def test_context_isolated_between_threads(routes):
+    barrier = threading.Barrier(2)
+
+    @routes('/thread/:name')
+    def handler(name):
+        barrier.wait(5)
+        return request.path
+
+    results = {}
+
+    def get(name):
+        results[name] = TestClient().get('/thread/%s' % name).text
+
+    threads = [threading.Thread(target=get, args=(name,)) for name in 'ab']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {'a': '/thread/a', 'b': '/thread/b'}
+
+
+def test_proxy_binds_new_object():
+    first = request.bind({'PATH_INFO': '/a'})
+    second = request.bind({'PATH_INFO': '/b'})
+    assert first is not second
+    assert first.path == '/a' and request.path == '/b'
+    request.custom = 1
+    assert second.custom == 1
+    del request.custom
+    assert not hasattr(request, 'custom')
+
+
+def test_async_handler_under_wsgi(client, routes, monkeypatch):
+    async def handler():
+        return 'never'
+
+    routes('/async')(handler)
+    monkeypatch.setattr(my_bottle, 'DEBUG', True)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        res = client.get('/async')
+    assert res.status == 500
+    assert 'async def handlers need an ASGI server' in res.text
+
+
+def test_asgi_handler(routes):
+    @routes('/echo', method='POST')
+    async def echo():
+        return {'body': request.body.read().decode(), 'form': request.POST}
+
+    @routes('/stream')
+    async def stream():
+        for i in range(3):
+            yield 'chunk%d ' % i
+
+    routes('/sync')(lambda: 'sync')
+    status, headers, body = asyncio.run(asgi_request(
+        '/echo', 'POST', b'a=1&b=2', [('Content-Type', 'application/x-www-form-urlencoded')]))
+    assert status == 200 and headers['content-type'] == 'application/json'
+    assert json.loads(body) == {'body': 'a=1&b=2', 'form': {'a': '1', 'b': '2'}}
+    assert asyncio.run(asgi_request('/stream'))[2] == b'chunk0 chunk1 chunk2 '
+    assert asyncio.run(asgi_request('/sync'))[2] == b'sync'
+    assert asyncio.run(asgi_request('/missing'))[0] == 404
+
+
+def test_asgi_repeated_headers(routes):
+    routes('/')(lambda: {'cookies': request.COOKIES, 'accept': request._environ['HTTP_ACCEPT']})
+    headers = [('Cookie', 'a=1'), ('Cookie', 'b=2'), ('Accept', 'text/html'), ('Accept', 'application/json')]
+    status, _, body = asyncio.run(asgi_request('/', headers=headers))
+    # HTTP/2 的每个 cookie 是单独的标头，合并后仍然可以解析出所有 cookie
+    assert json.loads(body) == {'cookies': {'a': '1', 'b': '2'}, 'accept': 'text/html,application/json'}
+
+
+def test_asgi_head_does_not_read_file(routes, tmp_path):
+    (tmp_path / 'big.bin').write_bytes(b'x' * 100000)
+    reads = []
+
+    class TrackedFile(io.FileIO):
+        def read(self, *args):
+            reads.append(args)
+            return io.FileIO.read(self, *args)
+
+    routes('/file', method='HEAD')(lambda: TrackedFile(str(tmp_path / 'big.bin')))
+    routes('/file')(lambda: TrackedFile(str(tmp_path / 'big.bin')))
+    status, headers, body = asyncio.run(asgi_request('/file', 'HEAD'))
+    assert status == 200 and headers['content-length'] == '100000' and body == b''
+    assert reads == []
+    assert asyncio.run(asgi_request('/file'))[2] == b'x' * 100000 and reads
+
+
+def test_query_and_params(client, routes):
+    routes('/q', method='POST')(lambda: {'get': request.GET, 'post': request.POST, 'params': request.params})
+    res = client.post('/q?a=1&a=2&b=3', data={'b': '4', 'c': '5'})
+    assert res.json() == {'get': {'a': ['1', '2'], 'b': '3'}, 'post': {'b': '4', 'c': '5'},
+                          'params': {'a': ['1', '2'], 'b': '4', 'c': '5'}}
+
+
+def test_cookies(client, routes):
+    @routes('/login')
+    def login():
+        response.set_cookie('session', 'abc', path='/', httponly=True)
+        response.set_cookie('theme', 'dark', **{'max-age': 3600})
+        return 'ok'
+
+    @routes('/logout')
+    def logout():
+        response.set_cookie('session', '', **{'max-age': 0})
+        return 'bye'
+
+    routes('/whoami')(lambda: request.COOKIES)
+    res = client.get('/login')
+    assert sorted(value.split('=')[0] for value in res.headers['Set-Cookie']) == ['session', 'theme']
+    assert 'HttpOnly' in [value for value in res.headers['Set-Cookie'] if value.startswith('session')][0]
+    assert client.get('/whoami').json() == {'session': 'abc', 'theme': 'dark'}
+    client.get('/logout')
+    assert client.get('/whoami').json() == {'theme': 'dark'}
+    assert client.get('/whoami', cookies={'extra': '1'}).json() == {'theme': 'dark', 'extra': '1'}
+
+
+def test_error_handlers(client, routes, monkeypatch):
+    monkeypatch.setattr(my_bottle, 'ERROR_HANDLER', dict(my_bottle.ERROR_HANDLER))
+    routes('/abort')(lambda: my_bottle.abort(401, 'Go away'))
+    routes('/crash')(lambda: 1 / 0)
+    routes('/redirect')(lambda: my_bottle.redirect('/elsewhere', 302))
+    res = client.get('/abort')
+    assert res.status == 401 and 'Go away' in res.text
+    assert client.get('/crash').status == 500
+    res = client.get('/redirect')
+    assert res.status == 302 and res.headers['Location'] == '/elsewhere'
+    my_bottle.set_error_handler(500, lambda exception: 'custom %s' % type(exception).__name__)
+    assert client.get('/crash').text == 'custom ZeroDivisionError'
+
+
+# 响应输出
+def test_output_str_encoded_once_with_charset(client, routes):
+    @routes('/latin')
+    def latin():
+        response.content_type = 'text/plain; charset=latin-1'
+        return ('caf', 'é')
+
+    res = client.get('/latin')
+    assert res.body == b'caf\xe9' and res.headers['Content-Length'] == '4'
+    routes('/utf8')(lambda: 'café')
+    res = client.get('/utf8')
+    assert res.body == 'café'.encode() and res.headers['Content-Length'] == '5'
+
+
+def test_output_empty_and_bytes(client, routes):
+    routes('/none')(lambda: None)
+    routes('/bytes')(lambda: (b'a', b'bc'))
+    res = client.get('/none')
+    assert res.body == b'' and res.headers['Content-Length'] == '0'
+    res = client.get('/bytes')
+    assert res.body == b'abc' and res.headers['Content-Length'] == '3'
+
+
+def test_output_json(client, routes, monkeypatch):
+    routes('/dict')(lambda: {'name': 'é', 'n': [1, 2]})
+    routes('/list')(lambda: [1, 'a', None])
+    res = client.get('/dict')
+    assert res.headers['Content-Type'] == 'application/json'
+    assert res.body == '{"name":"é","n":[1,2]}'.encode() and res.headers['Content-Length'] == str(len(res.body))
+    assert client.get('/list').json() == [1, 'a', None]
+
+    # 长列表逐个元素编码，分成多个片段输出
+    monkeypatch.setattr(my_bottle, 'JSON_STREAM_SIZE', 10)
+    items = [{'id': i, 'text': 'x' * 100} for i in range(2000)]
+    routes('/big')(lambda: items)
+    res = client.get('/big')
+    assert 'Content-Length' not in res.headers and res.json() == items
+
+    class Encoder(json.JSONEncoder):
+        def default(self, obj):
+            return sorted(obj) if isinstance(obj, set) else json.JSONEncoder.default(self, obj)
+
+    monkeypatch.setattr(my_bottle, 'JSON_ENCODER', Encoder())
+    routes('/set')(lambda: {'tags': {'b', 'a'}})
+    assert client.get('/set').json() == {'tags': ['a', 'b']}
+
+
+@pytest.mark.parametrize('output, body, content_type', [
+    ([], b'[]', 'application/json'),
+    (['a', 'b'], b'["a","b"]', 'application/json'),
+    ([b'a'], None, None),
+    (('a',), b'a', 'text/html; charset=UTF-8'),
+    ((), b'', 'text/html; charset=UTF-8'),
+])
+def test_output_list_is_json_tuple_is_chunks(client, routes, output, body, content_type):
+    routes('/out')(lambda: output)
+    res = client.get('/out')
+    if body is None:
+        # 字节串不能序列化为 JSON
+        assert res.status == 500
+    else:
+        assert res.status == 200 and res.body == body and res.headers['Content-Type'] == content_type
+
+
+def test_output_json_keeps_custom_content_type(client, routes):
+    @routes('/vendor')
+    def vendor():
+        response.content_type = 'application/vnd.api+json'
+        return []
+
+    res = client.get('/vendor')
+    assert res.headers['Content-Type'] == 'application/vnd.api+json' and res.body == b'[]'
+
+
+def test_output_generator(client, routes, monkeypatch):
+    routes('/gen')(lambda: (str(i) for i in range(3)))
+    res = client.get('/gen')
+    assert res.body == b'012' and 'Content-Length' not in res.headers
+
+    def failing():
+        raise ValueError('before the first chunk')
+        yield 'never'
+
+    # 第一个片段之前的异常仍然可以返回错误页面
+    routes('/failing')(failing)
+    monkeypatch.setattr(my_bottle, 'DEBUG', True)
+    res = client.get('/failing')
+    assert res.status == 500 and 'before the first chunk' in res.text
+
+    closed = []
+
+    def tracked():
+        try:
+            yield 'a'
+            yield 'b'
+        finally:
+            closed.append(True)
+
+    routes('/tracked')(tracked)
+    assert client.get('/tracked').body == b'ab' and closed == [True]
+
+
+def test_gzip_stage(client, routes, monkeypatch):
+    monkeypatch.setattr(my_bottle, 'GZIP_MIN_SIZE', 100)
+    monkeypatch.setattr(my_bottle, 'GZIP_CACHE', my_bottle.LRUCache(8))
+    routes('/big')(lambda: 'x' * 1000)
+    routes('/small')(lambda: 'x' * 10)
+
+    @routes('/image')
+    def image():
+        response.content_type = 'image/png'
+        return b'\x89PNG' * 100
+
+    res = client.get('/big', headers={'Accept-Encoding': 'gzip, br'})
+    assert res.headers['Content-Encoding'] == 'gzip' and res.headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(res.body) == b'x' * 1000 and res.headers['Content-Length'] == str(len(res.body))
+    client.get('/big', headers={'Accept-Encoding': 'gzip'})
+    assert my_bottle.GZIP_CACHE.hits == 1
+    res = client.get('/big', headers={'Accept-Encoding': 'gzip;q=0'})
+    assert 'Content-Encoding' not in res.headers and res.body == b'x' * 1000
+    assert 'Content-Encoding' not in client.get('/small', headers={'Accept-Encoding': 'gzip'}).headers
+    assert 'Content-Encoding' not in client.get('/image', headers={'Accept-Encoding': 'gzip'}).headers
+
+
+def test_gzip_stage_merges_vary(client, routes, monkeypatch):
+    monkeypatch.setattr(my_bottle, 'GZIP_MIN_SIZE', 100)
+
+    @routes('/vary/:value')
+    def vary(value):
+        response.header['Vary'] = value
+        return 'x' * 1000
+
+    assert client.get('/vary/Cookie', headers={'Accept-Encoding': 'gzip'}).headers['Vary'] == 'Cookie, Accept-Encoding'
+    assert client.get('/vary/accept-encoding').headers['Vary'] == 'accept-encoding'
+    assert client.get('/vary/*').headers['Vary'] == '*'
+
+
+# 请求体
+def test_multipart_form(client, routes, monkeypatch):
+    monkeypatch.setattr(my_bottle, 'MEMFILE_MAX', 1000)
+
+    @routes('/upload', method='POST')
+    def upload():
+        small, big = request.POST['small'], request.POST['big']
+        return {'name': request.POST['name'], 'tags': request.POST['tag'],
+                'small': [small.filename, small.type, small.value.decode(), small.file._rolled],
+                'big': [big.filename, big.size, big.value == b'x' * 5000, big.file._rolled]}
+
+    res = client.post('/upload', data=[('name', 'wörld'), ('tag', 'a'), ('tag', 'b')],
+                      files={'small': ('a.txt', b'hello'), 'big': ('b.bin', b'x' * 5000)})
+    assert res.json() == {'name': 'wörld', 'tags': ['a', 'b'], 'small': ['a.txt', 'text/plain', 'hello', False],
+                          'big': ['b.bin', 5000, True, True]}
+
+
+@pytest.mark.parametrize('limit, value, kargs', [
+    ('MAX_PARTS', 2, {'data': {'a': '1', 'b': '2', 'c': '3'}, 'files': {'f': ('f.txt', b'x')}}),
+    ('MAX_FIELD_SIZE', 10, {'data': {'a': 'x' * 11}, 'files': {'f': ('f.txt', b'x')}}),
+    ('MAX_PART_SIZE', 10, {'files': {'f': ('f.txt', b'x' * 11)}}),
+    ('MAX_BODY_SIZE', 100, {'files': {'f': ('f.txt', b'x' * 200)}}),
+    ('MAX_FIELD_SIZE', 10, {'data': {'a': 'x' * 20}}),
+])
+def test_form_limits(client, routes, monkeypatch, limit, value, kargs):
+    monkeypatch.setattr(my_bottle, limit, value)
+    routes('/form', method='POST')(lambda: str(len(request.POST)))
+    assert client.post('/form', **kargs).status == 413
+
+
+def test_multipart_split_across_chunks():
+    boundary = 'b0undary'
+    body = TestClient.encode_multipart({'a': 'x' * 300, 'b': 'y'}, {'f': ('f.txt', b'z' * 1000)}, boundary)
+    for size in (1, 7, 64, len(body)):
+        chunks = [body[i:i + size] for i in range(0, len(body), size)]
+        items = my_bottle.parse_multipart(chunks, boundary)
+        assert [(name, value if isinstance(value, str) else value.value) for name, value in items] == [
+            ('a', 'x' * 300), ('b', 'y'), ('f', b'z' * 1000)]
+
+
+def test_request_body_streaming(client, routes):
+    @routes('/ndjson', method='POST')
+    def ndjson():
+        return [json.loads(line) for line in request.iter_lines(chunk_size=4)]
+
+    @routes('/twice', method='POST')
+    def twice():
+        return [request.body.read().decode(), request.body.read().decode(), len(b''.join(request.iter_body()))]
+
+    assert client.post('/ndjson', body=b'{"a":1}\n{"b":2}\r\n{"c":3}').json() == [{'a': 1}, {'b': 2}, {'c': 3}]
+    assert client.post('/twice', body='abc').json() == ['abc', 'abc', 3]
+
+
+def test_request_body_chunked(routes):
+    @routes('/upload', method='POST')
+    def upload():
+        return b''.join(request.iter_body(chunk_size=3))
+
+    environ = TestClient().build_environ('/upload', 'POST', body=b'5\r\nhello\r\n6;ext=1\r\n world\r\n0\r\nX-Trailer: 1\r\n\r\n',
+                                         headers={'Transfer-Encoding': 'chunked'})
+    del environ['CONTENT_LENGTH']
+    body = b''.join(my_bottle.WSGIHandler(environ, lambda status, headers: None))
+    assert body == b'hello world'
+
+
+def test_request_body_consumed_once(routes):
+    request.bind(TestClient().build_environ('/', 'POST', body='abc'))
+    assert b''.join(request.iter_body()) == b'abc'
+    with pytest.raises(my_bottle.BottleException):
+        request.iter_body()
+
+
+def test_request_body_too_large(client, routes, monkeypatch):
+    monkeypatch.setattr(my_bottle, 'MAX_BODY_SIZE', 10)
+    routes('/body', method='POST')(lambda: request.body.read())
+    assert client.post('/body', body='x' * 10).body == b'x' * 10
+    assert client.post('/body', body='x' * 11).status == 413
+
+
+# 静态文件
+@pytest.fixture
+def static(client, routes, tmp_path):
+    """
+    在 /static/ 下提供 tmp_path 中的文件，返回写入文件的函数
+    """
+    routes('/static/:filename#.+#')(lambda filename: my_bottle.send_file(filename, root=str(tmp_path)))
+    routes('/weak/:filename#.+#')(lambda filename: my_bottle.send_file(filename, root=str(tmp_path), weak_etag=True))
+
+    def write(name, data):
+        (tmp_path / name).write_bytes(data)
+        return os.stat(tmp_path / name)
+
+    return write
+
+
+def test_send_file(client, static):
+    data = bytes(range(256)) * 10
+    static('data.bin', data)
+    static('page.html', b'<p>\xe4\xbd\xa0\xe5\xa5\xbd</p>')
+    res = client.get('/static/data.bin')
+    assert res.status == 200 and res.body == data
+    assert res.headers['Content-Length'] == str(len(data)) and res.headers['Accept-Ranges'] == 'bytes'
+    assert res.headers['Content-Type'] == 'application/octet-stream'
+    assert res.headers['ETag'].startswith('"') and 'Last-Modified' in res.headers
+    res = client.get('/static/page.html')
+    assert res.headers['Content-Type'] == 'text/html' and res.body == '<p>你好</p>'.encode()
+    assert client.get('/static/missing.txt').status == 404
+    assert client.get('/static/../secret.txt').status in (401, 404)
+
+
+def test_send_file_uses_file_wrapper(static, routes):
+    static('data.bin', b'x' * 100)
+
+    class Wrapper(my_bottle.FileWrapper):
+        pass
+
+    environ = TestClient().build_environ('/static/data.bin')
+    environ['wsgi.file_wrapper'] = Wrapper
+    output = my_bottle.WSGIHandler(environ, lambda status, headers: None)
+    assert isinstance(output, Wrapper) and b''.join(output) == b'x' * 100
+    output.close()
+
+
+@pytest.mark.parametrize('header, status, expected, content_range', [
+    ('bytes=0-9', 206, slice(0, 10), 'bytes 0-9/1000'),
+    ('bytes=990-', 206, slice(990, 1000), 'bytes 990-999/1000'),
+    ('bytes=-5', 206, slice(995, 1000), 'bytes 995-999/1000'),
+    ('bytes=500-5000', 206, slice(500, 1000), 'bytes 500-999/1000'),
+    ('bytes=0-4,3-9', 206, slice(0, 10), 'bytes 0-9/1000'),
+    ('bytes=1000-', 416, None, 'bytes */1000'),
+    ('items=0-9', 200, slice(0, 1000), None),
+    ('bytes=9-0', 200, slice(0, 1000), None),
+])
+def test_range(client, static, header, status, expected, content_range):
+    data = bytes(range(250)) * 4
+    static('data.bin', data)
+    res = client.get('/static/data.bin', headers={'Range': header})
+    assert res.status == status
+    assert res.headers.get('Content-Range') == content_range
+    assert res.body == (data[expected] if expected else b'')
+    assert res.headers['Content-Length'] == str(len(res.body))
+
+
+def test_multiple_ranges(client, static):
+    data = bytes(range(250)) * 4
+    static('data.bin', data)
+    res = client.get('/static/data.bin', headers={'Range': 'bytes=0-9,100-109,-5'})
+    assert res.status == 206
+    content_type, params = my_bottle.parse_header_params(res.headers['Content-Type'])
+    assert content_type == 'multipart/byteranges'
+    assert res.headers['Content-Length'] == str(len(res.body))
+    parts = res.body.split(b'--' + params['boundary'].encode())
+    assert parts[0] == b'' and parts[-1] == b'--\r\n'
+    found = []
+    for part in parts[1:-1]:
+        head, _, body = part.partition(b'\r\n\r\n')
+        assert b'Content-Type: application/octet-stream' in head
+        found.append((head.split(b'Content-Range: ')[1].decode(), body[:-2]))
+    assert found == [('bytes 0-9/1000', data[0:10]), ('bytes 100-109/1000', data[100:110]),
+                     ('bytes 995-999/1000', data[995:])]
+
+
+def test_if_range(client, static):
+    static('data.bin', b'0123456789')
+    etag = client.get('/static/data.bin').headers['ETag']
+    res = client.get('/static/data.bin', headers={'Range': 'bytes=0-1', 'If-Range': etag})
+    assert res.status == 206 and res.body == b'01'
+    res = client.get('/static/data.bin', headers={'Range': 'bytes=0-1', 'If-Range': '"other"'})
+    assert res.status == 200 and res.body == b'0123456789'
+    # 弱 ETag 不能用于 If-Range
+    weak = client.get('/weak/data.bin').headers['ETag']
+    assert weak.startswith('W/')
+    assert client.get('/weak/data.bin', headers={'Range': 'bytes=0-1', 'If-Range': weak}).status == 200
+
+
+def test_conditional_get(client, static):
+    stats = static('data.bin', b'0123456789')
+    res = client.get('/static/data.bin')
+    etag, last_modified = res.headers['ETag'], res.headers['Last-Modified']
+    assert etag == '"%x-%x-%x"' % (stats.st_ino, stats.st_size, stats.st_mtime_ns)
+    for headers in ({'If-None-Match': etag}, {'If-None-Match': '"x", W/%s' % etag}, {'If-None-Match': '*'},
+                    {'If-Modified-Since': last_modified}):
+        res = client.get('/static/data.bin', headers=headers)
+        assert res.status == 304 and res.body == b'' and res.headers['ETag'] == etag
+    assert client.get('/static/data.bin', headers={'If-None-Match': '"other"'}).status == 200
+    # If-None-Match 优先于 If-Modified-Since
+    res = client.get('/static/data.bin', headers={'If-None-Match': '"other"', 'If-Modified-Since': last_modified})
+    assert res.status == 200
+    assert client.get('/static/data.bin', headers={'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'}).status == 200
+    assert client.post('/static/data.bin', headers={'If-None-Match': etag}).status == 404
+
+
+def test_stat_cache_revalidated_on_open(client, static, tmp_path):
+    static('data.bin', b'old')
+    client.get('/static/data.bin')
+    static('data.bin', b'newer content')
+    # 缓存的文件状态已经过期时以实际打开的文件为准
+    res = client.get('/static/data.bin')
+    assert res.body == b'newer content' and res.headers['Content-Length'] == '13'
+
+
+def test_precompressed(client, static):
+    static('app.js', b'console.log(1)' * 10)
+    static('app.js.gz', gzip.compress(b'console.log(1)' * 10))
+    static('app.js.br', b'brotli data')
+    res = client.get('/static/app.js', headers={'Accept-Encoding': 'gzip'})
+    assert res.headers['Content-Encoding'] == 'gzip' and res.headers['Vary'] == 'Accept-Encoding'
+    assert res.headers['Content-Type'] == mimetypes.guess_type('app.js')[0]
+    assert gzip.decompress(res.body) == b'console.log(1)' * 10
+    assert res.headers['Content-Length'] == str(len(res.body))
+    res = client.get('/static/app.js', headers={'Accept-Encoding': 'gzip, br'})
+    assert res.headers['Content-Encoding'] == 'br' and res.body == b'brotli data'
+    res = client.get('/static/app.js')
+    assert 'Content-Encoding' not in res.headers and res.headers['Vary'] == 'Accept-Encoding'
+    assert res.body == b'console.log(1)' * 10
+    # 压缩版本和原文件的 ETag 不同
+    assert client.get('/static/app.js', headers={'Accept-Encoding': 'gzip'}).headers['ETag'] != res.headers['ETag']
+
+
+def test_precompressed_merges_vary(client, static, routes, tmp_path):
+    static('app.js', b'console.log(1)')
+    static('app.js.gz', gzip.compress(b'console.log(1)'))
+
+    @routes('/private/:filename')
+    def private(filename):
+        response.header['Vary'] = 'Cookie'
+        return my_bottle.send_file(filename, root=str(tmp_path))
+
+    headers = client.get('/private/app.js', headers={'Accept-Encoding': 'gzip'}).headers
+    assert headers['Vary'] == 'Cookie, Accept-Encoding' and headers['Content-Encoding'] == 'gzip'
+
+
+# 模板
+@pytest.fixture
+def templates(tmp_path, monkeypatch):
+    """
+    以临时目录作为唯一的模板目录，返回写入模板文件的函数
+    """
+    monkeypatch.setattr(my_bottle, 'TEMPLATE_PATH', [str(tmp_path)])
+    monkeypatch.setattr(my_bottle, 'TEMPLATES', my_bottle.LRUCache(256))
+
+    def write(name, source):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(source, encoding='utf-8')
+        # 保证修改时间发生变化
+        mtime = time.time() + len(source) % 7
+        os.utime(path, (mtime, mtime))
+        return str(path)
+
+    write.path = tmp_path
+    return write
+
+
+def layouts(templates):
+    templates('base.tpl', '<html>\n% base\n</html>\n')
+    templates('part.tpl', '<p>{{text}}</p>\n')
+    templates('page.tpl', '% rebase base\n<h1>{{title}}</h1>\n% include part text=title.lower()\n')
+
+
+def test_template_syntax():
+    tpl = SimpleTemplate('% for i in items:\n'
+                         '%   if i % 2:\n'
+                         '{{i}} odd\n'
+                         '%   elif i == 0:\n'
+                         'zero\n'
+                         '%   else:\n'
+                         '{{i}} even\n'
+                         '%   end\n'
+                         '% end\n'
+                         '% total = sum(items)\n'
+                         'total {{total}} {{name.upper()}}\n')
+    assert tpl.render(items=[0, 1, 2], name='x') == 'zero\n1 odd\n2 even\ntotal 3 X\n'
+
+
+def test_template_errors():
+    with pytest.raises(TemplateError):
+        SimpleTemplate('% end\n')
+    with pytest.raises(TemplateError):
+        SimpleTemplate('% include part, 1\n', filename='page.tpl')
+
+
+def test_template_bytecode_cache(templates, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    page = templates('page.tpl', '<h1>{{title}}</h1>\n')
+    assert SimpleTemplate.load(page, cache_dir).code is not None
+    cached = SimpleTemplate.load(page, cache_dir)
+    assert cached.code is None and cached.render(title='A') == '<h1>A</h1>\n'
+    # 模板变化后缓存失效
+    templates('page.tpl', '<h2>{{title}}</h2>\n')
+    fresh = SimpleTemplate.load(page, cache_dir)
+    assert fresh.code is not None and fresh.render(title='A') == '<h2>A</h2>\n'
+    with open(SimpleTemplate.cache_file(page, cache_dir), 'wb') as fp:
+        fp.write(b'garbage')
+    assert SimpleTemplate.load(page, cache_dir).render(title='B') == '<h2>B</h2>\n'
+
+
+def test_compile_templates(templates, tmp_path):
+    templates('a.tpl', 'a {{x}}\n')
+    templates('sub/b.tpl', 'b {{x}}\n')
+    cache_dir = str(tmp_path / 'cache')
+    assert my_bottle.compile_templates(str(templates.path), cache_dir) == 2
+    # 再次加载使用磁盘上的字节码缓存
+    tpl = SimpleTemplate.load(str(templates.path / 'sub' / 'b.tpl'), cache_dir)
+    assert tpl.code is None and tpl.render(x=1) == 'b 1\n'
+
+
+def test_template_bytecode_cache_with_layouts(templates, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    layouts(templates)
+    page = str(templates.path / 'page.tpl')
+    assert SimpleTemplate.load(page, cache_dir).code is not None
+    cached = SimpleTemplate.load(page, cache_dir)
+    assert cached.code is None and cached.render(title='A') == '<html>\n<h1>A</h1>\n<p>a</p>\n</html>\n'
+    # 被内联的模板变化后缓存失效
+    templates('part.tpl', '<em>{{text}}</em>\n')
+    fresh = SimpleTemplate.load(page, cache_dir)
+    assert fresh.code is not None and fresh.render(title='A') == '<html>\n<h1>A</h1>\n<em>a</em>\n</html>\n'
+
+
+def test_template_render_iter():
+    tpl = SimpleTemplate('% for i in range(100):\n{{i}},\n% end\n')
+    chunks = list(tpl.render_iter(_flush_size=20))
+    assert len(chunks) > 3
+    assert ''.join(chunks) == ''.join('%d,\n' % i for i in range(100))
+    assert tpl.render() == ''.join(chunks)
+    forced = SimpleTemplate('a\n% flush\nb\n')
+    assert list(forced.render_iter()) == ['a\n', 'b\n']
+
+
+def test_template_assigns_argument():
+    tpl = SimpleTemplate('% n = n + 1\n{{n}} {{[n for _ in range(2)]}}\n')
+    assert tpl.render(n=1) == '2 [2, 2]\n'
+
+
+def test_template_streamed_by_handler(client, routes):
+    tpl = SimpleTemplate('% for i in range(3):\n<li>{{i}}</li>\n% end\n')
+    routes('/list')(lambda: tpl.render_iter(_flush_size=1))
+    res = client.get('/list')
+    assert res.text == '<li>0</li>\n<li>1</li>\n<li>2</li>\n' and 'Content-Length' not in res.headers
+
+
+def test_template_cache_revalidation(templates, monkeypatch):
+    templates('hello.tpl', 'Hello {{who}}!')
+    monkeypatch.setattr(my_bottle, 'TEMPLATE_CHECK_INTERVAL', None)
+    assert my_bottle.template('hello', who='a') == 'Hello a!'
+    templates('hello.tpl', 'Hi {{who}}!')
+    # 从不检查时使用缓存的模板
+    assert my_bottle.template('hello', who='a') == 'Hello a!'
+    monkeypatch.setattr(my_bottle, 'TEMPLATE_CHECK_INTERVAL', 0)
+    assert my_bottle.template('hello', who='a') == 'Hi a!'
+
+
+def test_template_cache_lru(templates, monkeypatch):
+    monkeypatch.setattr(my_bottle, 'TEMPLATES', my_bottle.LRUCache(2))
+    for name in 'abc':
+        templates('%s.tpl' % name, name)
+        my_bottle.template(name)
+    assert 'a' not in my_bottle.TEMPLATES and 'c' in my_bottle.TEMPLATES
+    assert my_bottle.TEMPLATES.evictions == 1
+
+
+def test_template_search_path(templates, tmp_path, monkeypatch):
+    other = tmp_path / 'other'
+    other.mkdir()
+    (other / 'only.tpl').write_text('other')
+    templates('both.tpl', 'first')
+    (other / 'both.tpl').write_text('second')
+    monkeypatch.setattr(my_bottle, 'TEMPLATE_PATH', [str(templates.path), str(other)])
+    assert my_bottle.template('only') == 'other'
+    assert my_bottle.template('both') == 'first'
+    with pytest.raises(TemplateError):
+        my_bottle.template('missing')
+
+
+def test_preload_templates(templates):
+    templates('a.tpl', 'a')
+    templates('sub/b.tpl', 'b')
+    assert my_bottle.preload_templates() == 2
+    assert my_bottle.preload_templates() == 0
+    assert my_bottle.template('sub/b') == 'b'
+
+
+def test_template_rebase_and_include(templates):
+    layouts(templates)
+    assert my_bottle.template('page', title='Hi') == '<html>\n<h1>Hi</h1>\n<p>hi</p>\n</html>\n'
+    assert my_bottle.load_template('page').dependencies == [
+        str(templates.path / 'part.tpl'), str(templates.path / 'base.tpl')]
+
+
+def test_layout_rendered_alone_skips_base(templates):
+    layouts(templates)
+    assert my_bottle.template('base') == '<html>\n</html>\n'
+
+
+def test_compile_templates_with_layouts(templates, tmp_path):
+    layouts(templates)
+    cache_dir = str(tmp_path / 'cache')
+    assert my_bottle.compile_templates(str(templates.path), cache_dir) == 3
+    # 再次加载使用磁盘上的字节码缓存
+    tpl = SimpleTemplate.load(str(templates.path / 'page.tpl'), cache_dir)
+    assert tpl.code is None
+    assert tpl.render(title='Hi') == '<html>\n<h1>Hi</h1>\n<p>hi</p>\n</html>\n'
+
+
+def test_preload_templates_with_layouts(templates):
+    layouts(templates)
+    assert my_bottle.preload_templates() == 3
+    assert my_bottle.preload_templates() == 0
+
+
+def test_include_keyword_as_variable():
+    tpl = SimpleTemplate('% include = 1\n% rebase = [include]\n{{rebase[0]}}\n')
+    assert tpl.render() == '1\n'
+
+
+def test_recursive_include(templates):
+    templates('loop.tpl', '% include loop\n')
+    with pytest.raises(TemplateError):
+        my_bottle.template('loop')
+
+
+def test_include_does_not_change_parent_variables(templates):
+    templates('part.tpl', '% x = 99\n<p>{{text}} {{x}}</p>\n')
+    templates('page.tpl', '{{text}}\n% include part text="child"\n{{text}} {{x}}\n')
+    assert my_bottle.template('page', text='parent', x=1) == 'parent\n<p>child 99</p>\nparent 1\n'
+    # 参数在当前模板中不存在时，包含之后仍然不存在
+    templates('loop.tpl', '% for i in range(2):\n% include part text=i\n% end\n{{"text" in dir()}}\n')
+    assert my_bottle.template('loop', x=1) == '<p>0 99</p>\n<p>1 99</p>\nFalse\n'
+
+
+def test_rebase_does_not_change_child_variables(templates):
+    templates('frame.tpl', '% x = x + "!"\n<{{x}} {{title}}>\n% base\n</{{x}}>\n')
+    templates('page.tpl', '% rebase frame x="layout"\n{{x}} {{title}}\n% x = "page"\n')
+    assert my_bottle.template('page', x='arg', title='t') == '<layout! t>\narg t\n</layout!>\n'
+
+
+
+def test_cache_fragment(monkeypatch):
+    monkeypatch.setattr(my_bottle, 'FRAGMENTS', my_bottle.FragmentCache(16))
+    tpl = SimpleTemplate('% cache "nav", 60\n{{value}}\n% end\n{{value}}\n')
+    assert tpl.render(value=1) == '1\n1\n'
+    assert tpl.render(value=2) == '1\n2\n'
+    my_bottle.FRAGMENTS.clear()
+    assert tpl.render(value=3) == '3\n3\n'
+
+
+def test_cache_fragment_ttl_and_keys(monkeypatch):
+    monkeypatch.setattr(my_bottle, 'FRAGMENTS', my_bottle.FragmentCache(16))
+    calls = []
+    tpl = SimpleTemplate('% cache ("user", uid), ttl\n{{load(uid)}}\n% end\n')
+
+    def load(uid):
+        calls.append(uid)
+        return uid
+
+    assert tpl.render(uid=1, ttl=60, load=load) == '1\n'
+    assert tpl.render(uid=1, ttl=60, load=load) == '1\n'
+    assert tpl.render(uid=2, ttl=60, load=load) == '2\n'
+    assert calls == [1, 2]
+    tpl.render(uid=3, ttl=-1, load=load)
+    tpl.render(uid=3, ttl=-1, load=load)
+    assert calls == [1, 2, 3, 3]
+
+
+def test_cache_keyword_as_variable():
+    tpl = SimpleTemplate('% cache = {}\n% cache [\'a\'] = 1\n% cache |= {\'b\': 2}\n% cache: dict = cache\n{{cache}}\n')
+    assert tpl.render() == "{'a': 1, 'b': 2}\n"
+
+
+# 请求指标
+def test_metrics(client, routes, monkeypatch):
+    routes('/hello/:name')(lambda name: 'Hello %s!' % name)
+    routes('/stream')(lambda: iter(['a', 'bc']))
+    monkeypatch.setattr(my_bottle, 'METRICS', None)
+    my_bottle.enable_metrics()
+    for name in ('a', 'b', 'c'):
+        client.get('/hello/%s' % name)
+    client.get('/stream')
+    client.get('/missing')
+    res = client.get('/metrics')
+    assert res.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    lines = res.text.splitlines()
+    assert 'bottle_requests_total{method="GET",route="/hello/:name",status="2xx"} 3' in lines
+    assert 'bottle_response_bytes_total{method="GET",route="/hello/:name"} 24' in lines
+    assert 'bottle_request_duration_seconds_count{method="GET",route="/hello/:name"} 3' in lines
+    assert 'bottle_request_duration_seconds_bucket{method="GET",route="/hello/:name",le="+Inf"} 3' in lines
+    assert 'bottle_response_bytes_total{method="GET",route="/stream"} 3' in lines
+    assert 'bottle_requests_total{method="*",route="<unmatched>",status="4xx"} 1' in lines
+    # 请求 /metrics 本身正在处理中
+    assert 'bottle_requests_in_flight{method="GET",route="/metrics"} 1' in lines
+
+
+def test_metrics_bounded_series(client, routes, monkeypatch):
+    monkeypatch.setattr(my_bottle, 'METRICS', None)
+    for i in range(5):
+        routes('/page%d/:id' % i)(lambda id: id)
+    metrics = my_bottle.enable_metrics(endpoint=None, max_series=4)
+    for i in range(5):
+        client.get('/page%d/1' % i)
+    assert len(set(metrics.series.values())) == 4
+    assert 'route="<other>",status="2xx"} 3' in metrics.exposition()
+
+
+# 请求计时
+@pytest.fixture
+def slow_log(monkeypatch):
+    log = io.StringIO()
+    monkeypatch.setattr(my_bottle, 'SERVER_TIMING', True)
+    monkeypatch.setattr(my_bottle, 'SLOW_REQUEST_THRESHOLD', 0)
+    monkeypatch.setattr(my_bottle, 'SLOW_REQUEST_LOG', log)
+    return lambda: [json.loads(line) for line in log.getvalue().splitlines()]
+
+
+def test_timing_phases(client, routes, slow_log):
+    tpl = SimpleTemplate('{{title}}')
+
+    @routes('/form/:id', method='POST')
+    def form(id):
+        with request.timer('db'):
+            time.sleep(0.01)
+        return tpl.render(title=request.POST['title'])
+
+    res = client.post('/form/1?x=1', data={'title': 'hi'})
+    phases = [item.split(';')[0] for item in res.headers['Server-Timing'].split(', ')]
+    assert phases == ['match', 'db', 'body', 'template', 'handler', 'total']
+    entry = slow_log()[-1]
+    assert entry['route'] == '/form/:id' and entry['path'] == '/form/1' and entry['query'] == 'x=1'
+    assert entry['phases']['db'] >= 10 and entry['total_ms'] >= entry['phases']['handler']
+
+    def stream():
+        yield 'a'
+        time.sleep(0.01)
+        yield 'b'
+
+    routes('/stream')(stream)
+    assert client.get('/stream').body == b'ab'
+    entry = slow_log()[-1]
+    assert entry['path'] == '/stream' and entry['phases']['output'] >= 10
+
+
+def test_timing_threshold(client, routes, slow_log, monkeypatch):
+    monkeypatch.setattr(my_bottle, 'SERVER_TIMING', False)
+    monkeypatch.setattr(my_bottle, 'SLOW_REQUEST_THRESHOLD', 1.0)
+    routes('/fast')(lambda: 'ok')
+    res = client.get('/fast')
+    assert 'Server-Timing' not in res.headers and slow_log() == []
+
+
+def test_timing_disabled(client, routes):
+    routes('/')(lambda: str(request.timer('db') is my_bottle.NULL_TIMER))
+    assert client.get('/').text == 'True'
+
+
+def test_timing_records_handler_that_aborts(client, routes, slow_log, tmp_path):
+    (tmp_path / 'a.txt').write_text('hello')
+
+    def slow(then):
+        def handler():
+            time.sleep(0.02)
+            then()
+        return handler
+
+    routes('/abort')(slow(lambda: my_bottle.abort(400, 'bad')))
+    routes('/redirect')(slow(lambda: my_bottle.redirect('/elsewhere')))
+    routes('/file')(slow(lambda: my_bottle.send_file('a.txt', root=str(tmp_path))))
+    routes('/error')(slow(lambda: 1 / 0))
+    for path, status in (('/abort', 400), ('/redirect', 307), ('/file', 200), ('/error', 500)):
+        res = client.get(path)
+        assert res.status == status
+        assert 'handler;dur=' in res.headers['Server-Timing']
+        entry = slow_log()[-1]
+        assert entry['path'] == path and entry['status'] == status
+        assert entry['phases']['handler'] >= 20
+
+
+# 测试客户端
+def test_test_client_environ():
+    client = TestClient(host='example.com', headers={'X-Default': '1'})
+    environ = client.build_environ('/a%20b?x=1', 'put', query={'y': ['2', '3']}, headers={'Content-Type': 'text/csv'},
+                                   body='a,b')
+    assert environ['PATH_INFO'] == '/a b' and environ['QUERY_STRING'] == 'x=1&y=2&y=3'
+    assert environ['REQUEST_METHOD'] == 'PUT' and environ['HTTP_HOST'] == 'example.com'
+    assert environ['HTTP_X_DEFAULT'] == '1' and environ['CONTENT_TYPE'] == 'text/csv'
+    assert environ['CONTENT_LENGTH'] == '3' and environ['wsgi.input'].read() == b'a,b'
+    environ = client.build_environ('/', 'POST', json={'a': 1})
+    assert environ['CONTENT_TYPE'] == 'application/json' and environ['wsgi.input'].read() == b'{"a":1}'
+
+
+def test_test_client_custom_app():
+    def app(environ, start_response):
+        start_response('201 Created', [('X-Path', environ['PATH_INFO']), ('Set-Cookie', 'a=1'), ('Set-Cookie', 'b=2')])
+        return [b'created']
+
+    client = TestClient(app)
+    res = client.post('/things')
+    assert res.status == 201 and res.status_line == '201 Created' and res.text == 'created'
+    assert res.headers['x-path'] == '/things' and res.headers['Set-Cookie'] == ['a=1', 'b=2']
+    assert client.cookies == {'a': '1', 'b': '2'}
+
+
+# 基准测试
+def test_microbenchmarks_run(tmp_path):
+    bench = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench.py')
+    output = subprocess.run([sys.executable, bench, '--duration', '0.001', '--json'],
+                            check=True, capture_output=True).stdout
+    results = json.loads(output)
+    assert len(results) > 10 and all(item['ops'] > 0 for item in results)
+    # 与保存的结果比较，变慢超过阈值时返回非零状态
+    (tmp_path / 'old.json').write_text(json.dumps([dict(item, ops=item['ops'] * 100) for item in results]))
+    compared = subprocess.run([sys.executable, bench, 'match_url', '--duration', '0.001',
+                               '--compare', str(tmp_path / 'old.json')], capture_output=True)
+    assert compared.returncode == 1 and b'REGRESSION' in compared.stdout
+
+
+# 服务器
+@pytest.mark.parametrize('server', [my_bottle.WSGIRefServer, my_bottle.ThreadedServer, my_bottle.HTTP11Server,
+                                    my_bottle.PreforkServer])
+def test_server_sendfile_larger_than_socket_buffer(server, routes, tmp_path):
+    data = bytes(range(256)) * (40 * 1024)
+    (tmp_path / 'big.bin').write_bytes(data)
+    routes('/static/:filename')(lambda filename: my_bottle.send_file(filename, root=str(tmp_path)))
+    with live_server(server, workers=1) as port:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('GET', '/static/big.bin')
+        res = conn.getresponse()
+        # 客户端暂停读取，让服务器的发送缓冲区写满
+        time.sleep(0.3)
+        assert res.status == 200
+        assert res.read() == data
+        conn.close()
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('GET', '/static/big.bin', headers={'Range': 'bytes=1000-5000999'})
+        res = conn.getresponse()
+        time.sleep(0.3)
+        assert res.status == 206
+        assert res.read() == data[1000:5001000]
+        conn.close()
+
+
+@pytest.mark.parametrize('server', [my_bottle.WSGIRefServer, my_bottle.ThreadedServer, my_bottle.HTTP11Server,
+                                    my_bottle.PreforkServer])
+def test_server_not_modified_without_content_length(server, routes, tmp_path):
+    (tmp_path / 'data.bin').write_bytes(b'0123456789')
+    routes('/static/:filename')(lambda filename: my_bottle.send_file(filename, root=str(tmp_path)))
+    with live_server(server, workers=1) as port:
+        head = raw_request(port, b'GET /static/data.bin HTTP/1.0\r\n\r\n').partition(b'\r\n\r\n')[0]
+        etag = re.search(rb'ETag: (.*)', head, re.I).group(1).strip()
+        data = raw_request(port, b'GET /static/data.bin HTTP/1.0\r\nIf-None-Match: %s\r\n\r\n' % etag)
+        assert data.startswith(b'HTTP/1.0 304 ') and data.endswith(b'\r\n\r\n')
+        # 304 响应没有响应体，也不能带有 Content-Length
+        assert b'content-length' not in data.lower()
+
+
+@pytest.mark.parametrize('server', [my_bottle.WSGIRefServer, my_bottle.ThreadedServer, my_bottle.HTTP11Server,
+                                    my_bottle.PreforkServer, my_bottle.AsyncioServer])
+def test_server_basic_requests(server, routes):
+    routes('/hello/:name')(lambda name: 'Hello %s!' % name)
+    routes('/echo', method='POST')(lambda: request.body.read())
+    routes('/stream')(lambda: (str(i) for i in range(3)))
+    with live_server(server, workers=1) as port:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('GET', '/hello/world')
+        assert conn.getresponse().read() == b'Hello world!'
+        conn.close()
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('POST', '/echo', body=b'x' * 100000)
+        assert conn.getresponse().read() == b'x' * 100000
+        conn.close()
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('GET', '/stream')
+        assert conn.getresponse().read() == b'012'
+        conn.close()
+
+
+@pytest.mark.parametrize('server', [my_bottle.ThreadedServer, my_bottle.HTTP11Server])
+def test_threaded_server_slow_request_does_not_block(server, routes):
+    routes('/slow')(lambda: time.sleep(1) or 'slow')
+    routes('/fast')(lambda: 'fast')
+    with live_server(server, threads=2) as port:
+        slow = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        slow.request('GET', '/slow')
+        time.sleep(0.1)
+        started = time.time()
+        fast = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        fast.request('GET', '/fast')
+        assert fast.getresponse().read() == b'fast'
+        assert time.time() - started < 0.8
+        assert slow.getresponse().read() == b'slow'
+
+
+def test_threaded_server_rejects_when_full(routes):
+    routes('/slow')(lambda: time.sleep(1) or 'slow')
+    with live_server(my_bottle.ThreadedServer, threads=1, queue_size=0) as port:
+        slow = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        slow.request('GET', '/slow')
+        time.sleep(0.2)
+        data = raw_request(port, b'GET /slow HTTP/1.0\r\n\r\n')
+        assert data.startswith(b'HTTP/1.0 503 ')
+        assert slow.getresponse().read() == b'slow'
+
+
+def test_threaded_server_read_timeout(routes, capfd):
+    routes('/')(lambda: 'ok')
+    with live_server(my_bottle.ThreadedServer, threads=1, timeout=0.3) as port:
+        for data in (b'', b'GET / HTTP/1.1\r\n'):
+            with socket.create_connection(('127.0.0.1', port), timeout=5) as idle:
+                idle.sendall(data)
+                # 超时的连接被关闭，唯一的工作线程可以处理下一个请求
+                assert idle.recv(100) == b''
+        assert raw_request(port, b'GET / HTTP/1.0\r\n\r\n').endswith(b'ok')
+    assert 'Traceback' not in capfd.readouterr().err
+
+
+@pytest.mark.parametrize('server', [my_bottle.HTTP11Server, my_bottle.AsyncioServer])
+def test_keep_alive_and_pipelining(server, routes):
+    routes('/n/:n')(lambda n: 'n=%s' % n)
+    routes('/stream')(lambda: (str(i) for i in range(3)))
+    routes('/upload', method='POST')(lambda: b''.join(request.iter_body()))
+    with live_server(server) as port:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('GET', '/n/1')
+        res = conn.getresponse()
+        assert res.read() == b'n=1' and res.getheader('Connection') == 'keep-alive'
+        sock = conn.sock
+        conn.request('GET', '/stream')
+        res = conn.getresponse()
+        assert res.getheader('Transfer-Encoding') == 'chunked' and res.read() == b'012'
+        conn.request('POST', '/upload', body=iter([b'hello ', b'chunked']), encode_chunked=True,
+                     headers={'Transfer-Encoding': 'chunked'})
+        assert conn.getresponse().read() == b'hello chunked'
+        assert conn.sock is sock
+        conn.close()
+
+        pipelined = b''.join(b'GET /n/%d HTTP/1.1\r\nHost: x\r\n\r\n' % i for i in range(3))
+        data = raw_request(port, pipelined + b'GET /n/3 HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+        assert re.findall(b'n=\\d', data) == [b'n=0', b'n=1', b'n=2', b'n=3']
+        assert data.count(b'HTTP/1.1 200 OK') == 4
+
+
+def test_keep_alive_unread_body_is_drained(routes):
+    routes('/ignore', method='POST')(lambda: 'ignored')
+    routes('/')(lambda: 'next')
+    with live_server(my_bottle.HTTP11Server) as port:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('POST', '/ignore', body=b'x' * 100000)
+        assert conn.getresponse().read() == b'ignored'
+        conn.request('GET', '/')
+        assert conn.getresponse().read() == b'next'
+        conn.close()
+
+
+def test_keep_alive_limits(routes):
+    routes('/')(lambda: 'ok')
+    with live_server(my_bottle.HTTP11Server, max_keepalive_requests=2, keepalive_timeout=0.3) as port:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('GET', '/')
+        res = conn.getresponse()
+        assert res.getheader('Connection') == 'keep-alive' and res.read() == b'ok'
+        conn.request('GET', '/')
+        res = conn.getresponse()
+        assert res.getheader('Connection') == 'close' and res.read() == b'ok'
+        conn.close()
+        # HTTP/1.0 客户端和长度未知的响应
+        data = raw_request(port, b'GET / HTTP/1.0\r\n\r\n')
+        assert b'Connection: close' in data
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as idle:
+            idle.sendall(b'GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+            time.sleep(0.6)
+            # 空闲超时后服务器关闭连接
+            data = b''
+            while True:
+                chunk = idle.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            assert data.endswith(b'ok')
+
+
+def test_server_head_requests(routes):
+    routes('/', method='HEAD')(lambda: 'x' * 10)
+    routes('/')(lambda: 'ok')
+    with live_server(my_bottle.HTTP11Server) as port:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('HEAD', '/')
+        res = conn.getresponse()
+        assert res.getheader('Content-Length') == '10' and res.read() == b''
+        conn.request('GET', '/')
+        assert conn.getresponse().read() == b'ok'
+        conn.close()
+
+
+@pytest.mark.parametrize('server', [my_bottle.WSGIRefServer, my_bottle.HTTP11Server])
+def test_server_head_does_not_read_file(server, routes, tmp_path):
+    (tmp_path / 'big.bin').write_bytes(b'x' * 100000)
+    marker = tmp_path / 'read'
+
+    class TrackedFile(io.FileIO):
+        def read(self, *args):
+            with open(marker, 'a') as fp:
+                fp.write('read\n')
+            return io.FileIO.read(self, *args)
+
+    routes('/file', method='HEAD')(lambda: TrackedFile(str(tmp_path / 'big.bin')))
+    routes('/file')(lambda: TrackedFile(str(tmp_path / 'big.bin')))
+    with live_server(server) as port:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('HEAD', '/file')
+        res = conn.getresponse()
+        assert res.status == 200
+        assert res.getheader('Content-Length') == '100000'
+        assert res.read() == b''
+        if server is my_bottle.HTTP11Server:
+            # 持久连接上的下一个响应没有错位
+            conn.request('GET', '/file')
+            assert conn.getresponse().read() == b'x' * 100000
+        conn.close()
+    assert not marker.exists()
+
+
+def test_asyncio_server_http10_unknown_length_closes(routes):
+    routes('/stream')(lambda: iter(['a', 'b']))
+    with live_server(my_bottle.AsyncioServer) as port:
+        data = raw_request(port, b'GET /stream HTTP/1.0\r\nConnection: keep-alive\r\n\r\n')
+    head, _, body = data.partition(b'\r\n\r\n')
+    assert b'Connection: close' in head
+    assert b'Transfer-Encoding' not in head
+    assert body == b'ab'
+
+
+def test_asyncio_server_invalid_content_length(routes):
+    routes('/', method='POST')(lambda: 'ok')
+    with live_server(my_bottle.AsyncioServer) as port:
+        for length in (b'abc', b'-1'):
+            data = raw_request(port, b'POST / HTTP/1.1\r\nContent-Length: %s\r\n\r\n' % length)
+            assert data.startswith(b'HTTP/1.1 400 ')
+
+
+def test_asyncio_server_concurrent_slow_requests(routes):
+    @routes('/sleep')
+    async def sleep():
+        await asyncio.sleep(0.5)
+        return 'done'
+
+    with live_server(my_bottle.AsyncioServer) as port:
+        started = time.time()
+        conns = [http.client.HTTPConnection('127.0.0.1', port, timeout=10) for _ in range(10)]
+        for conn in conns:
+            conn.request('GET', '/sleep')
+        assert [conn.getresponse().read() for conn in conns] == [b'done'] * 10
+        assert time.time() - started < 2.5
+        for conn in conns:
+            conn.close()
+
+
+def test_prefork_workers_and_respawn(routes):
+    routes('/pid')(lambda: str(os.getpid()))
+    routes('/crash')(lambda: os._exit(1))
+    with live_server(my_bottle.PreforkServer, workers=2, max_requests=5) as port:
+        pids = set()
+        for _ in range(20):
+            pids.add(raw_request(port, b'GET /pid HTTP/1.0\r\n\r\n').split(b'\r\n\r\n')[1])
+        # 每个工作进程处理 5 个请求后被替换
+        assert len(pids) >= 4
+        raw_request(port, b'GET /crash HTTP/1.0\r\n\r\n')
+        time.sleep(0.2)
+        assert raw_request(port, b'GET /pid HTTP/1.0\r\n\r\n').startswith(b'HTTP/1.0 200 ')
+
+
+def test_prefork_graceful_shutdown(routes):
+    routes('/slow')(lambda: time.sleep(0.5) or 'finished')
+    listener = socket.create_server(('127.0.0.1', 0))
+    listener.set_inheritable(True)
+    port = listener.getsockname()[1]
+    pid = os.fork()
+    if pid == 0:
+        try:
+            my_bottle.run(server=my_bottle.PreforkServer, host='fd:%d' % listener.fileno(), quiet=True,
+                          access_log=False, workers=1)
+        finally:
+            os._exit(0)
+    listener.close()
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('GET', '/slow')
+        time.sleep(0.2)
+        os.kill(pid, signal.SIGTERM)
+        # 正在处理的请求完成后工作进程才退出
+        assert conn.getresponse().read() == b'finished'
+    finally:
+        os.waitpid(pid, 0)
+
+
+def test_prefork_metrics_aggregate(routes, monkeypatch):
+    routes('/')(lambda: 'ok')
+    monkeypatch.setattr(my_bottle, 'METRICS', None)
+    my_bottle.enable_metrics()
+    with live_server(my_bottle.PreforkServer, workers=2) as port:
+        for _ in range(10):
+            raw_request(port, b'GET / HTTP/1.0\r\n\r\n')
+        lines = raw_request(port, b'GET /metrics HTTP/1.0\r\n\r\n').decode().splitlines()
+    assert 'bottle_requests_total{method="GET",route="/",status="2xx"} 10' in lines
+
+
+def test_unix_socket(routes, tmp_path):
+    routes('/')(lambda: 'over unix')
+    path = str(tmp_path / 'app.sock')
+    with live_server(my_bottle.HTTP11Server, host='unix:' + path, unix_mode='600'):
+        for _ in range(50):
+            if os.path.exists(path):
+                break
+            time.sleep(0.05)
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.settimeout(5)
+            sock.connect(path)
+            sock.sendall(b'GET / HTTP/1.0\r\n\r\n')
+            data = b''
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        assert data.endswith(b'over unix')
+
+
+def test_unix_socket_private_until_chmod(tmp_path, monkeypatch):
+    path = str(tmp_path / 'app.sock')
+    modes = []
+    chmod = os.chmod
+
+    def record(target, mode):
+        modes.append(stat.S_IMODE(os.stat(target).st_mode))
+        chmod(target, mode)
+
+    monkeypatch.setattr(os, 'chmod', record)
+    umask = os.umask(0o022)
+    try:
+        my_bottle.ServerAdapter(host='unix:' + path, unix_mode='666').listen_socket().close()
+        # 套接字文件创建时只有所有者可以访问，之后才改为 unix_mode
+        assert modes == [0o600] and stat.S_IMODE(os.stat(path).st_mode) == 0o666
+        assert os.umask(0o022) == 0o022
+    finally:
+        os.umask(umask)
+
+
+def test_systemd_requires_listen_fds(monkeypatch):
+    monkeypatch.delenv('LISTEN_FDS', raising=False)
+    with pytest.raises(RuntimeError):
+        my_bottle.listen_fd('systemd')
+    monkeypatch.setenv('LISTEN_PID', str(os.getpid()))
+    monkeypatch.setenv('LISTEN_FDS', '1')
+    assert my_bottle.listen_fd('systemd') == 3
+    assert 'LISTEN_FDS' not in os.environ
+    assert my_bottle.listen_fd('fd:7') == 7
+
+
+def test_paste_server_rejects_unix_socket():
+    with pytest.raises(RuntimeError):
+        my_bottle.PasteServer(host='unix:/tmp/x.sock').run(None)
+
+
+def test_bench(routes):
+    routes('/')(lambda: 'Hello World!')
+    result = my_bottle.bench(my_bottle.HTTP11Server, '/', concurrency=2, duration=0.5, warmup=0.1)
+    assert result['server'] == 'HTTP11Server' and result['requests'] > 0 and result['errors'] == 0
+    assert result['status'] == {200: result['requests']}
+    latency = result['latency_ms']
+    assert 0 < latency['p50'] <= latency['p90'] <= latency['p99'] <= latency['max']
+
+
+def test_bench_bodyless_responses(routes):
+    routes('/', method='HEAD')(lambda: 'x' * 100)
+
+    @routes('/empty')
+    def empty():
+        response.status = 204
+        return ''
+
+    # HEAD 和 204 响应没有响应体，客户端不能一直等待
+    result = my_bottle.bench(my_bottle.HTTP11Server, '/', method='HEAD', concurrency=2, duration=0.3, warmup=0)
+    assert result['requests'] > 0 and result['status'] == {200: result['requests']}
+    result = my_bottle.bench(my_bottle.HTTP11Server, '/empty', concurrency=2, duration=0.3, warmup=0)
+    assert result['requests'] > 0 and result['status'] == {204: result['requests']}
+
+
+def test_bench_counts_requests_in_flight_at_deadline(routes):
+    routes('/slow')(lambda: time.sleep(1) or 'slow')
+    result = my_bottle.bench(my_bottle.HTTP11Server, '/slow', concurrency=2, duration=0.3, warmup=0, timeout=0.5)
+    # 截止时仍在进行、之后才超时的请求计入错误
+    assert result['requests'] == 0 and result['errors'] >= 2